@@ -1,56 +1,38 @@
-
 from __future__ import annotations
 import os
+import asyncio
+import logging
 from datetime import datetime, timedelta
-from typing import List, Dict, Any
+from typing import List, Optional
 import aiohttp
 
-TP_TOKEN  = os.getenv("TP_TOKEN", "")
+from .offers import Offer
+from .providers import FareQuery, fan_out, get_provider, safe_search
+
+log = logging.getLogger("avia-bot.aviasales")
+
 TP_MARKER = os.getenv("TP_MARKER", "")
 SUB_ID    = os.getenv("SUB_ID", "")
 CURRENCY  = os.getenv("DEFAULT_CURRENCY", "usd")
 LOCALE    = os.getenv("DEFAULT_LOCALE", "ru")
 
-import requests
-from datetime import datetime
-
 def ensure_iata(code: str) -> str:
     c = code.strip().upper()
     if len(c) != 3 or not c.isalpha():
         raise ValueError(f"IATA ожидалось из 3 букв, получил: {code}")
     return c
 
-def tp_search_prices_for_date(origin: str, destination: str, date: str):
+async def tp_search_prices_for_date(origin: str, destination: str, date: str, session: Optional[aiohttp.ClientSession] = None) -> List[Offer]:
     o = ensure_iata(origin)
     d = ensure_iata(destination)
 
     try:
-        datetime.strptime(date, "%Y-%m-%d")
+        day = datetime.strptime(date, "%Y-%m-%d").date()
     except ValueError:
         raise ValueError("Дата должна быть в формате YYYY-MM-DD")
 
-    url = "https://api.travelpayouts.com/aviasales/v3/prices_for_dates"
-    params = {
-        "origin": o,
-        "destination": d,
-        "departure_at": date,
-        "currency": CURRENCY,
-        "locale": LOCALE,
-        "limit": 5
-    }
-    headers = {"X-Access-Token": TP_TOKEN}
-
-    r = requests.get(url, params=params, headers=headers, timeout=15)
-    print("TP request:", r.url, "status:", r.status_code)
-    print("TP response:", r.text[:1000])
-
-    if r.status_code != 200:
-        return []
-
-    data = r.json().get("data", [])
-    if not isinstance(data, list):
-        return []
-    return data[:5]
+    q = FareQuery(o, d, day, CURRENCY, limit=5)
+    return await safe_search(get_provider("travelpayouts"), q, session)
 
 def tp_deeplink(origin: str, destination: str, date: str) -> str:
     o = ensure_iata(origin)
@@ -61,50 +43,37 @@ def tp_deeplink(origin: str, destination: str, date: str) -> str:
         qs += f"&sub_id={SUB_ID}"
     return f"{base}?{qs}"
 
-TP_TOKEN = os.getenv("TRAVELPAYOUTS_TOKEN", "")
 AFFILIATE_MARKER = os.getenv("AFFILIATE_MARKER", "YOUR_MARKER")
+# Сколько запросов по датам/аэропортам одного поиска идут параллельно
+SEARCH_CONCURRENCY = int(os.getenv("SEARCH_CONCURRENCY", "8"))
+
+async def _fetch_day(session: aiohttp.ClientSession, origin: str, dest: str, day: datetime, currency: str, limiter: asyncio.Semaphore) -> List[Offer]:
+    q = FareQuery(origin, dest, day.date(), currency, limit=7)
+    async with limiter:
+        per_provider = await asyncio.gather(*fan_out(q, session))
+    offers: List[Offer] = []
+    for found in per_provider:
+        for offer in found:
+            # Ссылка на покупку (маркер внутри)
+            # Формат поиска может отличаться; этот вариант демонстрационный
+            link = f"https://www.aviasales.com/search/{origin}{dest}{offer.departure_str('%d%m', '')}?marker={AFFILIATE_MARKER}"
+            offers.append(Offer(offer.price, offer.airline, offer.flight_number, offer.departure_ts,
+                                origin, dest, offer.transfers, link))
+    return offers
 
-async def fetch_cheapest(session: aiohttp.ClientSession, origin: str, dest: str, dep_date: datetime, days_flex: int = 0, currency: str = "UZS") -> List[Dict[str,Any]]:
-    results: List[Dict[str,Any]] = []
-    headers = {"Accept": "application/json"}
-    base_url = "https://api.travelpayouts.com/aviasales/v3/prices_for_dates"
-    for shift in range(-days_flex, days_flex+1):
-        d = dep_date + timedelta(days=shift)
-        params = {
-            "origin": origin,
-            "destination": dest,
-            "departure_at": d.strftime("%Y-%m-%d"),
-            "currency": currency,
-            "sorting": "price",
-            "limit": 7,
-            "token": TP_TOKEN,
-        }
-        async with session.get(base_url, params=params, headers=headers, timeout=20) as r:
-            if r.status == 200:
-                data = await r.json()
-                for it in data.get("data", []):
-                    dep = it.get("departure_at")
-                    price = it.get("price")
-                    transfers = it.get("transfers", 0)
-                    flight = it.get("flight_number","")
-                    # Ссылка на покупку (маркер внутри)
-                    # Формат поиска может отличаться; этот вариант демонстрационный
-                    date_ddmm = datetime.fromisoformat(dep.replace("Z","")).strftime("%d%m")
-                    link = f"https://www.aviasales.com/search/{origin}{dest}{date_ddmm}?marker={AFFILIATE_MARKER}"
-                    results.append({
-                        "price": price,
-                        "airline": it.get("airline",""),
-                        "flight_number": flight,
-                        "departure_at": dep,
-                        "transfers": transfers,
-                        "origin": origin,
-                        "destination": dest,
-                        "link": link,
-                    })
+async def fetch_cheapest(session: aiohttp.ClientSession, origin: str, dest: str, dep_date: datetime, days_flex: int = 0, currency: str = "UZS", limiter: Optional[asyncio.Semaphore] = None) -> List[Offer]:
+    # Все даты ±days_flex запрашиваются параллельно; limiter можно передать
+    # общий на весь поиск, чтобы ограничить суммарную параллельность.
+    limiter = limiter or asyncio.Semaphore(SEARCH_CONCURRENCY)
+    days = [dep_date + timedelta(days=shift) for shift in range(-days_flex, days_flex+1)]
+    per_day = await asyncio.gather(*[
+        _fetch_day(session, origin, dest, day, currency, limiter) for day in days
+    ])
+    results: List[Offer] = [o for offers in per_day for o in offers]
     # Сортировка и уникализация
     seen = set(); filtered = []
-    for x in sorted(results, key=lambda z: z["price"] or 9e12):
-        key = (x["departure_at"], x["flight_number"])
+    for x in sorted(results, key=lambda z: z.sort_price):
+        key = (x.departure_ts, x.flight_number)
         if key not in seen:
             seen.add(key); filtered.append(x)
     return filtered[:10]
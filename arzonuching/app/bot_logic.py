@@ -1,16 +1,20 @@
 
 from __future__ import annotations
-import os, asyncio, aiohttp
+import os, json, asyncio
 from datetime import datetime
 from typing import Dict, Any, List
 
 from aiogram import Bot, Dispatcher, F
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.types import Message, CallbackQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
-from .aviasales import fetch_cheapest
+from .aviasales import fetch_cheapest, SEARCH_CONCURRENCY
 from .payments import create_service_fee_invoice
+from .http_client import get_session
+from .offers import Offer
+from .budget import search_budget
+from .sessions import SessionStore, SessionMiddleware
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 CURRENCY = os.getenv("CURRENCY", "UZS")
@@ -36,7 +40,15 @@ TR_DESTS = [
     {"city":"Анкара (ESB)", "codes":["ESB"]},
 ]
 
-USER_STATE: Dict[int, Dict[str,Any]] = {}
+USER_STATE: SessionStore[Dict[str,Any]] = SessionStore("bot_logic")
+dp.message.outer_middleware(SessionMiddleware(USER_STATE))
+dp.callback_query.outer_middleware(SessionMiddleware(USER_STATE))
+
+def pack_state(st: Dict[str,Any]) -> bytes:
+    return json.dumps(st, ensure_ascii=False, separators=(",", ":")).encode()
+
+def unpack_state(blob: bytes) -> Dict[str,Any]:
+    return json.loads(blob)
 
 def route_keyboard() -> InlineKeyboardBuilder:
     kb = InlineKeyboardBuilder()
@@ -67,14 +79,13 @@ def date_keyboard():
     kb.adjust(2,2)
     return kb
 
-def format_card(x: Dict[str,Any]) -> str:
-    dt = datetime.fromisoformat(x["departure_at"].replace("Z",""))
-    tr = "без пересадок" if (x.get("transfers") or 0) == 0 else f"{x.get('transfers')} перес."
+def format_card(x: Offer) -> str:
+    tr = "без пересадок" if x.transfers == 0 else f"{x.transfers} перес."
     return (
-        f"💸 <b>{x['price']} {CURRENCY}</b> • {tr}\n"
-        f"🛫 {x['origin']} → {x['destination']} • {dt.strftime('%d.%m %H:%M')}\n"
-        f"✈️ {x.get('airline','')} {x.get('flight_number','')}\n"
-        f"🔗 <a href='{x['link']}'>Открыть на сайте</a>"
+        f"💸 <b>{x.price} {CURRENCY}</b> • {tr}\n"
+        f"🛫 {x.origin} → {x.destination} • {x.departure_str('%d.%m %H:%M')}\n"
+        f"✈️ {x.airline} {x.flight_number}\n"
+        f"🔗 <a href='{x.link}'>Открыть на сайте</a>"
     )
 
 @dp.message(Command("start"))
@@ -152,23 +163,28 @@ async def run_search(ctx, dep_str: str):
     reply = ctx.message.reply if hasattr(ctx, 'message') else ctx.reply
     await reply("Ищу самые дешёвые…")
 
-    all_offers: List[Dict[str,Any]] = []
-    async with aiohttp.ClientSession() as session:
-        for dest in grp["codes"]:
-            offs = await fetch_cheapest(session, origin, dest, dep_date, days_flex=3, currency=CURRENCY)
-            for o in offs:
-                o["destination"] = dest
-            all_offers.extend(offs)
+    all_offers: List[Offer] = []
+    session = get_session()
+    limiter = asyncio.Semaphore(SEARCH_CONCURRENCY)
+    with search_budget() as budget:
+        per_dest = await asyncio.gather(*[
+            fetch_cheapest(session, origin, dest, dep_date, days_flex=3, currency=CURRENCY, limiter=limiter)
+            for dest in grp["codes"]
+        ])
+    for offs in per_dest:
+        all_offers.extend(offs)
 
     if not all_offers:
         await reply("Ничего не нашлось. Попробуй другую дату/направление."); return
 
-    all_offers.sort(key=lambda z: z["price"] or 9e12)
+    all_offers.sort(key=lambda z: z.sort_price)
     free = all_offers[:3]
     paid = all_offers[3:10]
 
     free_text = "\n\n".join([f"{i+1}) "+format_card(x) for i,x in enumerate(free)])
     msg = "🎯 <b>Самые дешёвые (бесплатно):</b>\n\n" + free_text
+    if budget.stale_note():
+        msg += "\n\n" + budget.stale_note()
 
     if paid:
         inv = create_service_fee_invoice(uid)
@@ -212,7 +228,8 @@ async def avia_handler(msg: Message, command: CommandObject):
         return
 
     try:
-        flights = tp_search_prices_for_date(origin, dest, date)
+        with search_budget() as budget:
+            flights = await tp_search_prices_for_date(origin, dest, date)
     except Exception as e:
         await msg.answer(f"Ошибка: {e}")
         return
@@ -221,13 +238,14 @@ async def avia_handler(msg: Message, command: CommandObject):
     if flights:
         text += "Нашел варианты:\n"
         for item in flights:
-            price = item.get("price")
-            airline = item.get("airline")
-            dep = item.get("departure_at", "")[:16].replace("T", " ")
-            transfers = "без пересадок" if item.get("transfers") == 0 else f"{item.get('transfers')} перес."
-            text += f"≈ {price} USD • {airline} • {transfers} • {dep}\n"
+            dep = item.departure_str("%Y-%m-%d %H:%M", "")
+            transfers = "без пересадок" if item.transfers == 0 else f"{item.transfers} перес."
+            text += f"≈ {item.price} USD • {item.airline} • {transfers} • {dep}\n"
     else:
         text += "Прямые билеты не найдены.\n"
 
+    if budget.stale_note():
+        text += budget.stale_note() + "\n"
+
     deeplink = tp_deeplink(origin, dest, date)
     await msg.answer(text + "\nПолная выдача: " + deeplink)
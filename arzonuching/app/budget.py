@@ -0,0 +1,66 @@
+from __future__ import annotations
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+from . import metrics
+
+SEARCH_BUDGET = float(os.getenv("SEARCH_BUDGET", "12"))   # сквозной бюджет одного поиска, сек
+
+
+class SearchBudget:
+    """Дедлайн одного пользовательского поиска.
+
+    Объект кладётся в contextvar, поэтому его видят все задачи, запущенные
+    из хендлера; запросы к кэшу/апстриму ждут не дольше remaining().
+    Если вместо свежего ответа пришлось отдать устаревший из кэша,
+    запоминается его возраст — хендлер показывает пометку пользователю.
+    """
+
+    def __init__(self, seconds: float = SEARCH_BUDGET) -> None:
+        self.seconds = seconds
+        self.started = time.monotonic()
+        self.deadline = self.started + seconds
+        self.stale_age = 0.0
+        self.timed_out = False
+
+    def remaining(self) -> float:
+        return max(0.0, self.deadline - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.deadline
+
+    def note_stale(self, age: float) -> None:
+        self.stale_age = max(self.stale_age, age)
+        metrics.inc("budget.stale_served")
+
+    def note_timeout(self) -> None:
+        self.timed_out = True
+        metrics.inc("budget.timeouts")
+
+    def stale_note(self) -> str:
+        if not self.stale_age:
+            return ""
+        minutes = max(1, round(self.stale_age / 60))
+        return f"🕓 Цены от {minutes} мин назад — свежие не успели загрузиться."
+
+
+_current: ContextVar[Optional[SearchBudget]] = ContextVar("search_budget", default=None)
+
+
+def current_budget() -> Optional[SearchBudget]:
+    return _current.get()
+
+
+@contextmanager
+def search_budget(seconds: float = SEARCH_BUDGET) -> Iterator[SearchBudget]:
+    b = SearchBudget(seconds)
+    token = _current.set(b)
+    try:
+        yield b
+    finally:
+        metrics.observe("budget.search_ms", (time.monotonic() - b.started) * 1000)
+        _current.reset(token)
@@ -0,0 +1,341 @@
+from __future__ import annotations
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import date
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, TextIO, Tuple
+
+from . import metrics
+from .budget import current_budget
+from .l2cache import SQLiteL2, encode_key
+from .shmcache import ShmCache
+from .singleflight import SingleFlight
+from .tinylfu import CACHE_WINDOW_PCT, TinyLFU, admission_from_env
+from .ttl_policy import ttl_policy
+
+log = logging.getLogger("avia-bot.cache")
+
+# =============================
+# ENV
+# =============================
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "5000"))
+CACHE_TTL_DEFAULT = float(os.getenv("CACHE_TTL_DEFAULT", "600"))
+CACHE_TTL_EMPTY = float(os.getenv("CACHE_TTL_EMPTY", "60"))
+# Сколько хранить протухшую запись как запасной ответ при нехватке бюджета
+CACHE_STALE_MAX_AGE = float(os.getenv("CACHE_STALE_MAX_AGE", str(6 * 3600)))
+CACHE_TRACE_PATH = os.getenv("CACHE_TRACE_PATH", "")  # запись ключей обращений для сравнения политик
+
+# TTL по провайдеру, сек
+PROVIDER_TTL: Dict[str, float] = {
+    "travelpayouts": float(os.getenv("CACHE_TTL_TRAVELPAYOUTS", "900")),
+    "aviasales": float(os.getenv("CACHE_TTL_AVIASALES", "600")),
+    "tp_calendar": float(os.getenv("CACHE_TTL_CALENDAR", "1800")),
+}
+
+PriceKey = Tuple[Hashable, ...]
+
+
+class PriceCache:
+    """LRU-кэш с TTL на каждую запись и счётчиками попаданий/промахов.
+
+    Протухшие записи не удаляются сразу: до CACHE_STALE_MAX_AGE они
+    доступны через get_stale() как запасной ответ.
+
+    С подключённой разделяемой памятью (use_shared) записи хранятся там —
+    одна копия на все воркеры, — а в словаре процесса остаётся только то,
+    что туда не поместилось.
+
+    С фильтром допуска (admission, W-TinyLFU) новые записи сначала
+    попадают в маленькое LRU-окно; вытесненная из окна запись проходит
+    в основную область, только если к её ключу обращались чаще, чем к
+    кандидату на вытеснение оттуда. Разовые поиски не выталкивают
+    популярные маршруты.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = CACHE_MAX_ENTRIES,
+        admission: Optional[TinyLFU] = None,
+        window_pct: float = CACHE_WINDOW_PCT,
+    ) -> None:
+        self.maxsize = maxsize
+        # key -> (expires_at, stored_at, value); без admission — единственная область
+        self._data: "OrderedDict[PriceKey, Tuple[float, float, Any]]" = OrderedDict()
+        self._window: "OrderedDict[PriceKey, Tuple[float, float, Any]]" = OrderedDict()
+        self.admission = admission
+        self.window_size = max(1, int(maxsize * window_pct / 100)) if admission is not None else 0
+        self.shared: Optional[ShmCache] = None
+        self.trace: Optional[TextIO] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def use_shared(self, shared: Optional[ShmCache]) -> None:
+        self.shared = shared
+
+    def __len__(self) -> int:
+        return len(self._data) + len(self._window)
+
+    def _local(self, key: PriceKey) -> Optional[Tuple[float, float, Any]]:
+        item = self._data.get(key)
+        if item is None and self._window:
+            item = self._window.get(key)
+        return item
+
+    def _lookup(self, key: PriceKey) -> Optional[Tuple[float, float, Any]]:
+        item = self._local(key)
+        if item is None and self.shared is not None:
+            item = self.shared.get(key)
+        return item
+
+    def _times(self, key: PriceKey) -> Optional[Tuple[float, float]]:
+        item = self._local(key)
+        if item is not None:
+            return item[0], item[1]
+        return self.shared.peek(key) if self.shared is not None else None
+
+    def _drop(self, key: PriceKey) -> None:
+        self._data.pop(key, None)
+        self._window.pop(key, None)
+
+    def __contains__(self, key: PriceKey) -> bool:
+        times = self._times(key)
+        return times is not None and times[0] > time.time()
+
+    def get(self, key: PriceKey) -> Optional[Any]:
+        if self.trace is not None:
+            self.trace.write(encode_key(key) + "\n")
+        if self.admission is not None:
+            self.admission.record(key)
+        item = self._lookup(key)
+        if item is None:
+            self.misses += 1
+            metrics.inc("cache.miss")
+            ttl_policy.record(key, hit=False)
+            return None
+        now = time.time()
+        if item[0] <= now:
+            if now - item[1] > CACHE_STALE_MAX_AGE:
+                self._drop(key)
+            self.misses += 1
+            metrics.inc("cache.miss")
+            metrics.inc("cache.expired")
+            ttl_policy.record(key, hit=False)
+            return None
+        if key in self._data:
+            self._data.move_to_end(key)
+        elif key in self._window:
+            self._window.move_to_end(key)
+        self.hits += 1
+        metrics.inc("cache.hit")
+        ttl_policy.record(key, hit=True)
+        return item[2]
+
+    def ttl_left(self, key: PriceKey) -> float:
+        """Сколько секунд записи осталось до протухания (0 — нет или протухла); без учёта в статистике."""
+        times = self._times(key)
+        return max(0.0, times[0] - time.time()) if times is not None else 0.0
+
+    def get_stale(self, key: PriceKey) -> Optional[Tuple[Any, float]]:
+        """(значение, возраст в секундах) — даже если TTL уже истёк."""
+        item = self._lookup(key)
+        if item is None:
+            return None
+        age = time.time() - item[1]
+        if age > CACHE_STALE_MAX_AGE:
+            return None
+        return item[2], age
+
+    def set(self, key: PriceKey, value: Any, ttl: float) -> None:
+        now = time.time()
+        self.put(key, value, now + ttl, now)
+
+    def put(self, key: PriceKey, value: Any, expires_at: float, stored_at: float) -> None:
+        """Положить запись с заданными сроками (из L2 или снимка — с исходными)."""
+        if self.shared is not None and self.shared.put(key, value, expires_at, stored_at):
+            self._drop(key)
+            return
+        item = (expires_at, stored_at, value)
+        if self.admission is None or key in self._data:
+            self._data[key] = item
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._evicted()
+        else:
+            self._window[key] = item
+            self._window.move_to_end(key)
+            while len(self._window) > self.window_size:
+                self._promote(*self._window.popitem(last=False))
+        metrics.gauge("cache.size", len(self))
+
+    def _promote(self, key: PriceKey, item: Tuple[float, float, Any]) -> None:
+        """Запись, вытесненная из окна, — в основную область или вон."""
+        if len(self._data) < self.maxsize - self.window_size:
+            self._data[key] = item
+            return
+        victim = next(iter(self._data))
+        if self.admission.admit(key, victim):
+            del self._data[victim]
+            self._data[key] = item
+        self._evicted()
+
+    def _evicted(self) -> None:
+        self.evictions += 1
+        metrics.inc("cache.evicted")
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._window.clear()
+
+    def items(self) -> List[Tuple[PriceKey, float, float, Any]]:
+        """(key, expires_at, stored_at, value) записей процесса — от давних к свежим."""
+        return [
+            (k, exp, stored, v)
+            for region in (self._data, self._window)
+            for k, (exp, stored, v) in region.items()
+        ]
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
+
+
+price_cache = PriceCache(admission=admission_from_env(CACHE_MAX_ENTRIES))
+if CACHE_TRACE_PATH:
+    # ключи всех обращений — для python -m app.cache_replay
+    price_cache.trace = open(CACHE_TRACE_PATH, "a", encoding="utf-8", buffering=1 << 16)
+inflight = SingleFlight("cache.coalesced")
+# второй уровень (SQLite), общий для воркеров; подключается при старте
+price_l2: Optional[SQLiteL2] = None
+
+
+def attach_l2(l2: Optional[SQLiteL2]) -> None:
+    global price_l2
+    price_l2 = l2
+
+
+def price_key(provider: str, origin: str, destination: str, day: Any, currency: str, limit: int = 0) -> PriceKey:
+    d = day.isoformat() if isinstance(day, date) else str(day)[:10]
+    return (provider, origin.upper(), destination.upper(), d, currency.lower(), limit)
+
+
+def ttl_for(provider: str) -> float:
+    return PROVIDER_TTL.get(provider, CACHE_TTL_DEFAULT)
+
+
+def ttl_for_key(provider: str, key: PriceKey, value: Any) -> float:
+    """TTL конкретной записи: базовый TTL провайдера с поправками ttl_policy."""
+    if not value:
+        return ttl_policy.ttl(key, CACHE_TTL_EMPTY, empty=True)
+    return ttl_policy.ttl(key, ttl_for(provider))
+
+
+def _storing(
+    provider: str, key: PriceKey, loader: Callable[[], Awaitable[Any]], use_l2: bool = True
+) -> Callable[[], Awaitable[Any]]:
+    """loader, кладущий результат в кэш с TTL по ttl_policy.
+
+    С подключённым L2 сначала смотрит туда: свежая строка отдаётся без
+    похода в апстрим, протухшая поднимается в память как запасной ответ.
+    Новое значение пишется в оба уровня.
+    """
+
+    async def load() -> Any:
+        l2 = price_l2
+        if l2 is not None and use_l2:
+            try:
+                row = await l2.get(key)
+            except Exception as e:
+                row = None
+                metrics.inc("cache.l2.errors")
+                log.warning(f"L2 cache read failed: {e}")
+            if row is not None:
+                value, expires_at, stored_at = row
+                local = price_cache.get_stale(key)
+                if local is None or stored_at > time.time() - local[1]:
+                    price_cache.put(key, value, expires_at, stored_at)
+                if expires_at > time.time():
+                    return value
+        value = await loader()
+        previous = price_cache.get_stale(key)
+        if previous is not None:
+            ttl_policy.observe(key, previous[0], value)
+        now = time.time()
+        expires_at = now + ttl_for_key(provider, key, value)
+        price_cache.put(key, value, expires_at, now)
+        if l2 is not None:
+            l2.put(key, value, expires_at, now)
+        return value
+
+    return load
+
+
+def _retrieve(task: asyncio.Future) -> None:
+    # загрузка, досчитанная в фоне после таймаута, не должна ругаться в лог
+    if not task.cancelled():
+        task.exception()
+
+
+async def cached_fetch(
+    provider: str,
+    key: PriceKey,
+    loader: Callable[[], Awaitable[Any]],
+    empty: Callable[[], Any] = list,
+) -> Any:
+    """Вернуть значение из кэша или загрузить его через loader и положить в кэш.
+
+    Одновременные промахи по одному ключу склеиваются в один запрос.
+    Если апстрим ответил ошибкой (или предохранитель разомкнут), отдаётся
+    протухшая запись из кэша. Внутри search_budget() ожидание ограничено
+    остатком бюджета: по его исчерпании — та же протухшая запись, а без
+    неё empty(). Загрузка при этом доводится до конца в фоне и обновляет кэш.
+    """
+    hit = price_cache.get(key)
+    if hit is not None:
+        return hit
+
+    load = _storing(provider, key, loader)
+    budget = current_budget()
+    failed: Optional[BaseException] = None
+    try:
+        if budget is None:
+            return await inflight.do(key, load)
+        task = asyncio.ensure_future(inflight.do(key, load))
+        task.add_done_callback(_retrieve)
+        return await asyncio.wait_for(asyncio.shield(task), budget.remaining())
+    except asyncio.TimeoutError as e:
+        if budget is not None and budget.expired:
+            budget.note_timeout()
+        else:
+            failed = e
+    except Exception as e:
+        # в т.ч. разомкнутый предохранитель провайдера — отвечаем из кэша
+        failed = e
+    stale = price_cache.get_stale(key)
+    if stale is not None:
+        metrics.inc("cache.stale_served")
+        if budget is not None:
+            budget.note_stale(stale[1])
+        return stale[0]
+    if failed is not None:
+        raise failed
+    return empty()
+
+
+async def refresh(provider: str, key: PriceKey, loader: Callable[[], Awaitable[Any]]) -> Any:
+    """Загрузить значение мимо кэша и положить в кэш (фоновое обновление).
+
+    Попадания и промахи не считаются; одновременный интерактивный запрос
+    того же ключа склеится с этой загрузкой. L2 не читается — это
+    обновление, — но новое значение туда записывается.
+    """
+    return await inflight.do(key, _storing(provider, key, loader, use_l2=False))
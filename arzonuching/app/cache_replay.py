@@ -0,0 +1,86 @@
+"""Сравнение LRU и W-TinyLFU на записанной трассе ключей.
+
+    CACHE_TRACE_PATH=trace.txt  # включить запись в работающем боте
+    python -m app.cache_replay trace.txt --size 5000
+    python -m app.cache_replay --synthetic 200000 --size 1000
+
+На каждый ключ трассы — get(); при промахе — set(), как при загрузке
+из провайдера. TTL бесконечный: сравниваются только политики вытеснения.
+"""
+from __future__ import annotations
+import math
+import random
+import argparse
+from typing import Dict, Iterable, List, Optional
+
+from .cache import PriceCache
+from .tinylfu import CACHE_WINDOW_PCT, TinyLFU
+
+
+def read_trace(path: str) -> List[str]:
+    with open(path, encoding="utf-8") as f:
+        return [line.rstrip("\n") for line in f if line.strip()]
+
+
+def synthetic_trace(length: int, popular: int = 5000, one_off: float = 0.3, seed: int = 1) -> List[str]:
+    """Zipf по популярным маршрутам вперемешку с разовыми поисками."""
+    rnd = random.Random(seed)
+    weights = [1 / (i + 1) for i in range(popular)]
+    cum = []
+    total = 0.0
+    for w in weights:
+        total += w
+        cum.append(total)
+    out: List[str] = []
+    for n in range(length):
+        if rnd.random() < one_off:
+            out.append(f"once|{n}")
+        else:
+            i = min(popular - 1, _bisect(cum, rnd.random() * total))
+            out.append(f"route|{i}")
+    return out
+
+
+def _bisect(cum: List[float], x: float) -> int:
+    lo, hi = 0, len(cum)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if cum[mid] < x:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def replay(keys: Iterable[str], size: int, admission: Optional[TinyLFU] = None,
+           window_pct: float = CACHE_WINDOW_PCT) -> Dict[str, float]:
+    cache = PriceCache(size, admission=admission, window_pct=window_pct)
+    for k in keys:
+        key = (k,)
+        if cache.get(key) is None:
+            cache.set(key, True, math.inf)
+    return cache.stats()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m app.cache_replay", description=__doc__.splitlines()[0])
+    parser.add_argument("trace", nargs="?", help="файл CACHE_TRACE_PATH")
+    parser.add_argument("--synthetic", type=int, metavar="N", help="вместо файла — синтетическая трасса из N обращений")
+    parser.add_argument("--size", type=int, default=5000, help="ёмкость кэша (CACHE_MAX_ENTRIES)")
+    parser.add_argument("--window-pct", type=float, default=CACHE_WINDOW_PCT, help="окно W-TinyLFU, %% ёмкости")
+    args = parser.parse_args(argv)
+    if args.synthetic:
+        keys = synthetic_trace(args.synthetic)
+    elif args.trace:
+        keys = read_trace(args.trace)
+    else:
+        parser.error("нужен файл трассы или --synthetic N")
+
+    print(f"{len(keys)} обращений, {len(set(keys))} ключей, ёмкость {args.size}")
+    for name, admission in (("lru", None), ("tinylfu", TinyLFU(args.size))):
+        s = replay(keys, args.size, admission, args.window_pct)
+        print(f"{name:8} hit ratio {s['hit_ratio']:.2%}  (hits {s['hits']}, evictions {s['evictions']})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+from __future__ import annotations
+import os
+import logging
+from typing import Optional
+
+import aiohttp
+
+log = logging.getLogger("avia-bot.http")
+
+# =============================
+# ENV
+# =============================
+HTTP_TOTAL_TIMEOUT = float(os.getenv("HTTP_TOTAL_TIMEOUT", "20"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "15"))
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "20"))
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", "300"))
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", "60"))
+
+# Одна сессия на процесс: keep-alive соединения к api.travelpayouts.com
+# переиспользуются между запросами, TLS-рукопожатие делается один раз.
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def _make_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+        ttl_dns_cache=HTTP_DNS_TTL,
+        use_dns_cache=True,
+        keepalive_timeout=HTTP_KEEPALIVE,
+        enable_cleanup_closed=True,
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=HTTP_TOTAL_TIMEOUT,
+        sock_connect=HTTP_CONNECT_TIMEOUT,
+        sock_read=HTTP_READ_TIMEOUT,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=timeout,
+        headers={"Accept": "application/json", "Accept-Encoding": "gzip, deflate"},
+    )
+
+
+async def init_session() -> aiohttp.ClientSession:
+    """Создать общую сессию при старте процесса."""
+    global _session
+    if _session is None or _session.closed:
+        _session = _make_session()
+        log.info(
+            "HTTP pool ready (limit=%s, per_host=%s, dns_ttl=%ss)",
+            HTTP_POOL_LIMIT, HTTP_POOL_LIMIT_PER_HOST, HTTP_DNS_TTL,
+        )
+    return _session
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Вернуть общую сессию; если старт её не создал — создать лениво."""
+    global _session
+    if _session is None or _session.closed:
+        _session = _make_session()
+    return _session
+
+
+async def close_session() -> None:
+    """Закрыть общую сессию при остановке процесса."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+        log.info("HTTP pool closed")
+    _session = None
@@ -0,0 +1,196 @@
+from __future__ import annotations
+import os
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+from array import array
+from typing import Any, Dict, Hashable, List, Optional, Set, Tuple
+
+from . import metrics
+from .offers import Offer, pack_offers, unpack_offers
+
+log = logging.getLogger("avia-bot.cache")
+
+# =============================
+# ENV
+# =============================
+PRICE_L2_PATH = os.getenv("PRICE_L2_PATH", "")                        # пусто — второй уровень выключен
+PRICE_L2_FLUSH_INTERVAL = float(os.getenv("PRICE_L2_FLUSH_INTERVAL", "0.5"))  # сек между пачками записи
+PRICE_L2_BATCH = int(os.getenv("PRICE_L2_BATCH", "200"))               # записей в пачке — пишем сразу
+PRICE_L2_CLEANUP_INTERVAL = float(os.getenv("PRICE_L2_CLEANUP_INTERVAL", "300"))
+PRICE_L2_KEEP_STALE = float(os.getenv("PRICE_L2_KEEP_STALE", str(6 * 3600)))  # протухшее храним как запасной ответ
+
+# (value, expires_at, stored_at) — время по time.time()
+Row = Tuple[Any, float, float]
+
+
+def encode_key(key: Tuple[Hashable, ...]) -> str:
+    return "|".join("" if k is None else str(k) for k in key)
+
+
+def pack_value(value: Any) -> Optional[bytes]:
+    """Значение кэша цен -> bytes; None — тип не поддерживается (в L2 не пишем)."""
+    if isinstance(value, array):
+        return b"A" + array("q", value).tobytes()
+    if isinstance(value, list) and all(isinstance(v, Offer) for v in value):
+        return b"O" + pack_offers(value)
+    return None
+
+
+def unpack_value(blob: bytes) -> Any:
+    kind, body = blob[:1], blob[1:]
+    if kind == b"A":
+        a = array("q")
+        a.frombytes(body)
+        return array("l", a)
+    if kind == b"O":
+        return unpack_offers(body)
+    raise ValueError(f"unknown L2 value kind {kind!r}")
+
+
+class SQLiteL2:
+    """Второй уровень кэша цен в локальном SQLite (WAL), общий для воркеров.
+
+    Чтение — точечный SELECT по первичному ключу. Запись копится в памяти
+    и сбрасывается одной транзакцией (executemany) раз в
+    PRICE_L2_FLUSH_INTERVAL или по набору PRICE_L2_BATCH записей.
+    Протухшие строки удаляются фоном по индексу expires_at.
+    """
+
+    _SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS prices ("
+        " key TEXT PRIMARY KEY, value BLOB NOT NULL, stored_at REAL NOT NULL, expires_at REAL NOT NULL"
+        ") WITHOUT ROWID",
+        "CREATE INDEX IF NOT EXISTS prices_expires ON prices (expires_at)",
+    )
+    _SELECT = "SELECT value, expires_at, stored_at FROM prices WHERE key = ?"
+    _UPSERT = (
+        "INSERT INTO prices (key, value, stored_at, expires_at) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT (key) DO UPDATE SET value = excluded.value, stored_at = excluded.stored_at, "
+        "expires_at = excluded.expires_at WHERE excluded.stored_at >= prices.stored_at"
+    )
+    _CLEANUP = "DELETE FROM prices WHERE expires_at <= ?"
+
+    def __init__(self, path: str = PRICE_L2_PATH) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        for stmt in self._SCHEMA:
+            self._db.execute(stmt)
+        self._pending: Dict[str, Tuple[bytes, float, float]] = {}
+        self._flush_now = asyncio.Event()
+        self._tasks: Set[asyncio.Task] = set()
+
+    # ---------- чтение ----------
+    def _get(self, k: str) -> Optional[Tuple[bytes, float, float]]:
+        with self._lock:
+            return self._db.execute(self._SELECT, (k,)).fetchone()
+
+    async def get(self, key: Tuple[Hashable, ...]) -> Optional[Row]:
+        k = encode_key(key)
+        pending = self._pending.get(k)
+        row = pending if pending is not None else await asyncio.to_thread(self._get, k)
+        if row is None:
+            metrics.inc("cache.l2.miss")
+            return None
+        blob, expires_at, stored_at = row
+        try:
+            value = unpack_value(bytes(blob))
+        except Exception as e:
+            log.warning(f"L2 cache: bad row {k}: {e}")
+            return None
+        metrics.inc("cache.l2.hit" if expires_at > time.time() else "cache.l2.stale")
+        return value, expires_at, stored_at
+
+    # ---------- запись ----------
+    def put(self, key: Tuple[Hashable, ...], value: Any, expires_at: float, stored_at: float) -> None:
+        blob = pack_value(value)
+        if blob is None:
+            return
+        self._pending[encode_key(key)] = (blob, expires_at, stored_at)
+        if len(self._pending) >= PRICE_L2_BATCH:
+            self._flush_now.set()
+
+    def _write(self, rows: List[Tuple[str, bytes, float, float]]) -> None:
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(self._UPSERT, rows)
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    async def flush(self) -> int:
+        if not self._pending:
+            return 0
+        batch, self._pending = self._pending, {}
+        rows = [(k, blob, stored, exp) for k, (blob, exp, stored) in batch.items()]
+        t0 = time.perf_counter()
+        try:
+            await asyncio.to_thread(self._write, rows)
+        except Exception as e:
+            log.warning(f"L2 cache flush failed ({len(rows)} rows): {e}")
+            # не затираем более свежие записи, пришедшие за время сбоя
+            for k, v in batch.items():
+                self._pending.setdefault(k, v)
+            return 0
+        metrics.observe("cache.l2.flush_ms", (time.perf_counter() - t0) * 1000)
+        metrics.observe("cache.l2.flush_batch", len(rows))
+        return len(rows)
+
+    async def _flush_forever(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), PRICE_L2_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            await self.flush()
+
+    # ---------- очистка ----------
+    def _cleanup(self) -> int:
+        with self._lock:
+            return self._db.execute(self._CLEANUP, (time.time() - PRICE_L2_KEEP_STALE,)).rowcount
+
+    async def cleanup(self) -> int:
+        return await asyncio.to_thread(self._cleanup)
+
+    async def _cleanup_forever(self) -> None:
+        while True:
+            await asyncio.sleep(PRICE_L2_CLEANUP_INTERVAL)
+            try:
+                removed = await self.cleanup()
+                if removed:
+                    log.info("L2 cache: removed %s expired rows", removed)
+            except Exception as e:
+                log.warning(f"L2 cache cleanup failed: {e}")
+
+    def start(self) -> None:
+        for coro in (self._flush_forever(), self._cleanup_forever()):
+            task = asyncio.create_task(coro)
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def close(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        for task in list(self._tasks):
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        with self._lock:
+            self._db.close()
+
+
+def l2_from_env() -> Optional[SQLiteL2]:
+    if not PRICE_L2_PATH:
+        return None
+    log.info("Price cache L2: sqlite (%s)", PRICE_L2_PATH)
+    return SQLiteL2(PRICE_L2_PATH)
@@ -1,13 +1,13 @@
 from __future__ import annotations
 import os
+import json
 import asyncio
 import calendar
 import logging
 from dataclasses import dataclass, field
 from datetime import date, timedelta
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Sequence, Tuple
 
-import aiohttp
 from aiogram import Bot, Dispatcher, F
 from aiogram.types import (
     Message,
@@ -21,6 +21,22 @@ from aiogram.filters import CommandStart
 from aiogram.client.bot import DefaultBotProperties
 from aiogram.enums import ParseMode
 
+from .http_client import init_session, close_session
+from .cache import attach_l2, price_cache
+from .l2cache import l2_from_env
+from .shmcache import shm_from_env
+from .snapshot import CACHE_SNAPSHOT_PATH, load_snapshot, run_snapshots, save_snapshot
+from .ttl_policy import ttl_policy
+from .providers import FareQuery, TP_TOKENS, fan_out, stats_summary, run_prober
+from . import metrics
+from .price_calendar import range_prices, cached_month, month_prices
+from .sessions import SessionStore, SessionMiddleware
+from .session_backends import backend_from_env
+from .offers import Offer
+from .progressive import MessageUpdater, progressive_merge
+from .budget import search_budget
+from .prefetch import PREFETCH_ENABLED, cancel_speculation, demand, run_refresher, speculate
+
 # =============================
 # LOGGING
 # =============================
@@ -31,17 +47,17 @@ log = logging.getLogger("avia-bot")
 # ENV
 # =============================
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
-TP_API_TOKEN = os.getenv("TP_API_TOKEN", "")      # Travelpayouts token
-AVS_API_TOKEN = os.getenv("AVS_API_TOKEN", "")    # Aviasales token (optional)
 CURRENCY = os.getenv("CURRENCY", "uzs").lower()   # uzs, usd, rub, etc.
 REF_LINK_TEMPLATE = os.getenv("REF_LINK_TEMPLATE", "")
 REF_SUBID = os.getenv("REF_SUBID", "")
 MANAGERS_CHAT_ID = int(os.getenv("MANAGERS_CHAT_ID", "0"))
+CALENDAR_PRICES = os.getenv("CALENDAR_PRICES", "0") == "1"          # цены в календаре по умолчанию
+CALENDAR_PRICE_STYLE = os.getenv("CALENDAR_PRICE_STYLE", "price")   # price | marker
 
 if not BOT_TOKEN:
     raise SystemExit("Please set BOT_TOKEN env var.")
-if not TP_API_TOKEN:
-    log.warning("TP_API_TOKEN not set. Real price search will not work.")
+if not TP_TOKENS:
+    log.warning("TP_TOKENS / TP_API_TOKEN not set. Real price search will not work.")
 
 # =============================
 # STATIC DATA
@@ -74,12 +90,45 @@ class QueryState:
     destination_label: Optional[str] = None
     depart_date: Optional[date] = None
     return_date: Optional[date] = None
-    results: List[dict] = field(default_factory=list)
+    results: List[Offer] = field(default_factory=list)
     page: int = 0
     selected_idx: Optional[int] = None
     adding_return: bool = False
+    show_prices: bool = CALENDAR_PRICES
+    calendar_month: Optional[date] = None
+
+def _day(v: Optional[int]) -> Optional[date]:
+    return date.fromordinal(v) if v else None
+
+def _ord(d: Optional[date]) -> Optional[int]:
+    return d.toordinal() if d else None
+
+def pack_state(st: QueryState) -> bytes:
+    # Компактно: массив значений в фиксированном порядке, даты — ordinal,
+    # результаты — Offer.to_row()
+    return json.dumps([
+        st.origin, st.origin_label, st.destination, st.destination_label,
+        _ord(st.depart_date), _ord(st.return_date),
+        [r.to_row() for r in st.results],
+        st.page, st.selected_idx, int(st.adding_return), int(st.show_prices), _ord(st.calendar_month),
+    ], ensure_ascii=False, separators=(",", ":")).encode()
+
+def unpack_state(blob: bytes) -> QueryState:
+    (origin, origin_label, destination, destination_label, depart, ret,
+     results, page, selected_idx, adding_return, show_prices, cal_month) = json.loads(blob)
+    return QueryState(
+        origin=origin, origin_label=origin_label,
+        destination=destination, destination_label=destination_label,
+        depart_date=_day(depart), return_date=_day(ret),
+        results=[Offer.from_row(r) for r in results],
+        page=page, selected_idx=selected_idx,
+        adding_return=bool(adding_return), show_prices=bool(show_prices),
+        calendar_month=_day(cal_month),
+    )
+
+user_state: SessionStore[QueryState] = SessionStore("main")
 
-user_state: Dict[int, QueryState] = {}
+SESSION_EXPIRED_TEXT = "Сессия устарела. Нажмите /start, чтобы выбрать направление и дату ✈️"
 
 # =============================
 # HELPERS
@@ -98,6 +147,14 @@ def fmt_price(v: Optional[int]) -> str:
         return "—"
     return f"{v:,}".replace(",", " ") + f" {CURRENCY.upper()}"
 
+def fmt_price_short(v: int) -> str:
+    # Для кнопок календаря: 2 450 000 -> 2.4M, 850 000 -> 850k
+    if v >= 1_000_000:
+        return f"{v / 1_000_000:.1f}".rstrip("0").rstrip(".") + "M"
+    if v >= 1_000:
+        return f"{v // 1_000}k"
+    return str(v)
+
 # =============================
 # KEYBOARDS
 # =============================
@@ -127,7 +184,21 @@ def month_days(year: int, month: int) -> List[List[Optional[int]]]:
         weeks.append(row)
     return weeks
 
-def calendar_kb(target: date, selected: Optional[date] = None) -> InlineKeyboardMarkup:
+def price_marks(prices: Sequence[int]) -> Tuple[int, int]:
+    # Границы «дёшево»/«дорого»: нижняя и верхняя треть известных цен месяца
+    known = sorted(p for p in prices if p)
+    if len(known) < 3:
+        return 0, 0
+    return known[len(known) // 3], known[(2 * len(known)) // 3]
+
+def calendar_kb(
+    target: date,
+    selected: Optional[date] = None,
+    prices: Optional[Sequence[int]] = None,
+    show_prices: Optional[bool] = None,
+) -> InlineKeyboardMarkup:
+    # prices — месячная матрица из price_calendar (index = day-1, 0 = нет цены)
+    # show_prices — если задан, рисуется кнопка переключения режима цен
     today = date.today()
     y, m = target.year, target.month
     weeks = month_days(y, m)
@@ -143,6 +214,7 @@ def calendar_kb(target: date, selected: Optional[date] = None) -> InlineKeyboard
     ])
     rows.append([InlineKeyboardButton(text=t, callback_data="noop") for t in WEEKDAYS_RU])
 
+    cheap, dear = price_marks(prices) if prices and CALENDAR_PRICE_STYLE == "marker" else (0, 0)
     for w in weeks:
         row: List[InlineKeyboardButton] = []
         for d in w:
@@ -154,13 +226,71 @@ def calendar_kb(target: date, selected: Optional[date] = None) -> InlineKeyboard
                     row.append(InlineKeyboardButton(text="·", callback_data="noop"))
                 else:
                     label = f"[{d}]" if selected and dt == selected else str(d)
+                    p = prices[d - 1] if prices and d <= len(prices) else 0
+                    if p and CALENDAR_PRICE_STYLE == "marker":
+                        if cheap and p <= cheap:
+                            label += "🟢"
+                        elif dear and p >= dear:
+                            label += "🔴"
+                    elif p:
+                        label = f"{label}·{fmt_price_short(p)}"
                     row.append(InlineKeyboardButton(text=label, callback_data=f"cal:set:{dt.isoformat()}"))
         rows.append(row)
 
-    rows.append([InlineKeyboardButton(text="🔥 Ближайшие дешёвые даты", callback_data="cal:near:7")])
+    rows.append([
+        InlineKeyboardButton(text="🔥 Ближайшие дешёвые даты", callback_data="cal:near:7"),
+        InlineKeyboardButton(text="📅 Цены на 30 дней", callback_data="cal:near:30"),
+    ])
+    if show_prices is not None:
+        rows.append([InlineKeyboardButton(
+            text="🙈 Скрыть цены" if show_prices else "💲 Показать цены",
+            callback_data=f"cal:prices:{target.replace(day=1).isoformat()}",
+        )])
     rows.append([InlineKeyboardButton(text="↩️ Назад", callback_data="back:dest")])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
+_background_tasks: set = set()
+
+def user_calendar(user_id: int, st: QueryState, message: Message, target: date) -> InlineKeyboardMarkup:
+    """Календарь пользователя. Цены берутся только из кэша; если месяца
+    в кэше нет, он догружается в фоне и клавиатура перерисовывается."""
+    st.calendar_month = target.replace(day=1)
+    prices = None
+    if st.show_prices and st.origin and st.destination:
+        prices = cached_month(st.origin, st.destination, target.year, target.month)
+        if prices is None:
+            task = asyncio.create_task(fill_calendar_prices(user_id, message, target))
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+    return calendar_kb(target, selected=st.depart_date, prices=prices, show_prices=st.show_prices)
+
+async def fill_calendar_prices(user_id: int, message: Message, target: date) -> None:
+    st = user_state.get(user_id)
+    if not st or not st.origin or not st.destination:
+        return
+    origin, destination = st.origin, st.destination
+    try:
+        prices = await month_prices(origin, destination, target.year, target.month)
+    except Exception as e:
+        log.warning(f"Calendar prices failed: {e}")
+        return
+    # Пользователь мог уйти с этого месяца или маршрута, пока шла загрузка;
+    # с бэкендом сессий каждый апдейт даёт новый объект — перечитываем
+    st = user_state.get(user_id)
+    if (
+        not prices
+        or not st
+        or not st.show_prices
+        or st.calendar_month != target.replace(day=1)
+        or (st.origin, st.destination) != (origin, destination)
+    ):
+        return
+    kb = calendar_kb(target, selected=st.depart_date, prices=prices, show_prices=True)
+    try:
+        await message.edit_reply_markup(reply_markup=kb)
+    except Exception:
+        pass
+
 def results_kb(visible: int, start_index: int, has_more: bool, can_add_return: bool = True) -> InlineKeyboardMarkup:
     rows: List[List[InlineKeyboardButton]] = []
     for i in range(visible):
@@ -175,75 +305,6 @@ def results_kb(visible: int, start_index: int, has_more: bool, can_add_return: b
     rows.append(nav)
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
-# =============================
-# API CLIENTS
-# =============================
-async def fetch_travelpayouts(origin: str, destination: str, depart: date, limit: int = 20) -> List[dict]:
-    if not TP_API_TOKEN:
-        return []
-    url = (
-        "https://api.travelpayouts.com/aviasales/v3/prices_for_dates"
-        f"?origin={origin}&destination={destination}&departure_at={depart.strftime('%Y-%m-%d')}"
-        f"&currency={CURRENCY}&limit={limit}&page=1&sorting=price&direct=false&unique=false&one_way=true"
-        f"&token={TP_API_TOKEN}"
-    )
-    async with aiohttp.ClientSession() as s:
-        async with s.get(url, timeout=20) as r:
-            if r.status != 200:
-                return []
-            data = await r.json()
-            return data.get("data", [])
-
-async def fetch_aviasales(origin: str, destination: str, depart: date, limit: int = 20) -> List[dict]:
-    if not AVS_API_TOKEN:
-        return []
-    url = (
-        "https://api.aviasales.com/v3/prices_for_dates"
-        f"?origin={origin}&destination={destination}&departure_at={depart.strftime('%Y-%m-%d')}"
-        f"&currency={CURRENCY}&limit={limit}&sorting=price&one_way=true"
-    )
-    headers = {"X-Access-Token": AVS_API_TOKEN}
-    try:
-        async with aiohttp.ClientSession() as s:
-            async with s.get(url, headers=headers, timeout=20) as r:
-                if r.status != 200:
-                    return []
-                data = await r.json()
-                return data.get("data", [])
-    except Exception:
-        return []
-
-def merge_results(*lists: List[dict], limit: int = 40) -> List[dict]:
-    pool: List[dict] = []
-    for lst in lists:
-        pool.extend(lst)
-    normalized: List[dict] = []
-    for item in pool:
-        price = item.get("price") or item.get("value")
-        airline = item.get("airline") or item.get("gate") or ""
-        depart_at = item.get("departure_at") or item.get("departure_at_iso") or ""
-        flight_number = item.get("flight_number") or ""
-        link = item.get("link") or item.get("deeplink") or ""
-        normalized.append({
-            "price": int(price) if str(price).isdigit() else price,
-            "airline": airline,
-            "link": link,
-            "departure_at": depart_at,
-            "flight_number": flight_number,
-        })
-    normalized.sort(key=lambda x: (x["price"] if isinstance(x["price"], int) else 10**12))
-    seen = set()
-    unique: List[dict] = []
-    for n in normalized:
-        k = (n.get("airline"), n.get("departure_at"))
-        if k in seen:
-            continue
-        seen.add(k)
-        unique.append(n)
-        if len(unique) >= limit:
-            break
-    return unique
-
 # =============================
 # RENDERING
 # =============================
@@ -266,27 +327,49 @@ def build_results_text(q: QueryState) -> str:
 
     lines: List[str] = []
     for i, r in enumerate(chunk, start=start + 1):
-        dt = r.get("departure_at")
-        d_show, t_show = "—", "—"
-        if isinstance(dt, str) and len(dt) >= 16 and "-" in dt and "T" in dt:
-            _y, m, d = dt[:10].split("-")
-            d_show = f"{d}.{m}"
-            t_show = dt[11:16]
-        airline = r.get("airline", "")
-        price = fmt_price(r.get("price"))
         lines.append(
-            f"{i}) 💸 {price}\n"
-            f"✈️ {airline}\n"
-            f"⏰ Вылет: {d_show} • {t_show}"
+            f"{i}) 💸 {fmt_price(r.price)}\n"
+            f"✈️ {r.airline}\n"
+            f"⏰ Вылет: {r.departure_str('%d.%m')} • {r.departure_str('%H:%M')}"
         )
 
     return "\n".join(head_lines + lines) + "\n"
 
+def results_view(q: QueryState, loading: bool = False, note: str = "") -> Tuple[str, InlineKeyboardMarkup]:
+    text = build_results_text(q)
+    if loading:
+        text += "\n⏳ Загружаю ещё варианты…"
+    if note:
+        text += "\n" + note
+    start_idx = q.page * PAGE_SIZE
+    if loading:
+        # пока приходят ответы, список пересортировывается: номера кнопок
+        # «Купить» указывали бы не на те предложения
+        return text, results_kb(visible=0, start_index=start_idx, has_more=False, can_add_return=False)
+    has_more = len(q.results) > start_idx + PAGE_SIZE
+    kb = results_kb(
+        visible=min(PAGE_SIZE, len(q.results) - start_idx),
+        start_index=start_idx,
+        has_more=has_more,
+        can_add_return=q.return_date is None,
+    )
+    return text, kb
+
 # =============================
 # BOT
 # =============================
 bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher()
+dp.message.outer_middleware(SessionMiddleware(user_state))
+dp.callback_query.outer_middleware(SessionMiddleware(user_state))
+
+async def active_session(c: CallbackQuery) -> Optional[QueryState]:
+    # Сессия могла истечь или быть вытеснена — тогда просим начать заново
+    st = user_state.get(c.from_user.id)
+    if not st or not st.origin:
+        await c.answer(SESSION_EXPIRED_TEXT, show_alert=True)
+        return None
+    return st
 
 @dp.message(CommandStart())
 async def on_start(m: Message):
@@ -297,6 +380,44 @@ async def on_start(m: Message):
 async def ping(m: Message):
     await m.answer("pong")
 
+TG_MESSAGE_LIMIT = 4096
+
+
+def split_message(text: str, limit: int = TG_MESSAGE_LIMIT) -> List[str]:
+    """Разбить текст на куски не длиннее limit, по границам строк."""
+    chunks: List[str] = []
+    cur = ""
+    for line in text.split("\n"):
+        while len(line) > limit:  # строка длиннее лимита — режем как есть
+            if cur:
+                chunks.append(cur)
+                cur = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if cur and len(cur) + 1 + len(line) > limit:
+            chunks.append(cur)
+            cur = line
+        else:
+            cur = f"{cur}\n{line}" if cur else line
+    if cur:
+        chunks.append(cur)
+    return chunks
+
+@dp.message(F.text == "/stats")
+async def stats(m: Message):
+    if not MANAGERS_CHAT_ID or m.chat.id != MANAGERS_CHAT_ID:
+        return
+    c = price_cache.stats()
+    head = f"Кэш цен: {c['size']} записей, hit ratio {c['hit_ratio']:.0%}"
+    if price_cache.shared is not None:
+        sh = price_cache.shared.stats()
+        head += f"\nОбщая память: {sh['used']}/{sh['slots']} слотов"
+    if ttl_policy.summary():
+        head += "\n" + ttl_policy.summary()
+    # метрик с провайдерами, токенами и корзинами TTL больше лимита одного сообщения
+    for chunk in split_message(head + "\n" + stats_summary() + "\n\n" + metrics.format_snapshot()):
+        await m.answer(chunk)
+
 @dp.message(F.text)
 async def any_text(m: Message):
     st = user_state.get(m.from_user.id)
@@ -323,17 +444,22 @@ async def pick_origin(c: CallbackQuery):
 @dp.callback_query(F.data.startswith("pick:dest:"))
 async def pick_dest(c: CallbackQuery):
     _, _, iata, city = c.data.split(":", 3)
-    st = user_state.setdefault(c.from_user.id, QueryState())
+    st = await active_session(c)
+    if st is None:
+        return
     st.destination = iata
     st.destination_label = city
+    demand.record(st.origin, iata)
     today = date.today()
     start_month = today if today.day <= 25 else (today.replace(day=28) + timedelta(days=4)).replace(day=1)
+    # пока пользователь смотрит на календарь, греем кэш вероятных дат
+    speculate(c.from_user.id, st.origin, iata, start_month)
     await c.message.edit_text(
         "\n".join([
             f"Маршрут: {st.origin} → {st.destination}",
             "Выбери дату вылета:"
         ]),
-        reply_markup=calendar_kb(start_month, selected=st.depart_date),
+        reply_markup=user_calendar(c.from_user.id, st, c.message, start_month),
     )
     await c.answer()
 
@@ -341,42 +467,52 @@ async def pick_dest(c: CallbackQuery):
 async def cal_prev(c: CallbackQuery):
     iso = c.data.split(":", 2)[2]
     target = date.fromisoformat(iso)
-    st = user_state.setdefault(c.from_user.id, QueryState())
-    await c.message.edit_reply_markup(reply_markup=calendar_kb(target, selected=st.depart_date))
+    st = await active_session(c)
+    if st is None:
+        return
+    await c.message.edit_reply_markup(reply_markup=user_calendar(c.from_user.id, st, c.message, target))
     await c.answer()
 
 @dp.callback_query(F.data.startswith("cal:next:"))
 async def cal_next(c: CallbackQuery):
     iso = c.data.split(":", 2)[2]
     target = date.fromisoformat(iso)
-    st = user_state.setdefault(c.from_user.id, QueryState())
-    await c.message.edit_reply_markup(reply_markup=calendar_kb(target, selected=st.depart_date))
+    st = await active_session(c)
+    if st is None:
+        return
+    await c.message.edit_reply_markup(reply_markup=user_calendar(c.from_user.id, st, c.message, target))
+    await c.answer()
+
+@dp.callback_query(F.data.startswith("cal:prices:"))
+async def cal_prices(c: CallbackQuery):
+    iso = c.data.split(":", 2)[2]
+    target = date.fromisoformat(iso)
+    st = await active_session(c)
+    if st is None:
+        return
+    st.show_prices = not st.show_prices
+    await c.message.edit_reply_markup(reply_markup=user_calendar(c.from_user.id, st, c.message, target))
     await c.answer()
 
 @dp.callback_query(F.data.startswith("cal:set:"))
 async def cal_set(c: CallbackQuery):
     iso = c.data.split(":", 2)[2]
     chosen = date.fromisoformat(iso)
-    st = user_state.setdefault(c.from_user.id, QueryState())
+    st = await active_session(c)
+    if st is None:
+        return
 
     if st.adding_return:
         st.return_date = chosen
         st.adding_return = False
         await c.answer("Дата обратного вылета выбрана")
-        text = build_results_text(st)
-        start_idx = st.page * PAGE_SIZE
-        has_more = len(st.results) > start_idx + PAGE_SIZE
-        kb = results_kb(
-            visible=min(PAGE_SIZE, len(st.results) - start_idx),
-            start_index=start_idx,
-            has_more=has_more,
-            can_add_return=st.return_date is None,
-        )
+        text, kb = results_view(st)
         await c.message.edit_text(text, reply_markup=kb, disable_web_page_preview=True)
         return
 
     st.depart_date = chosen
     st.page = 0
+    demand.record(st.origin, st.destination, chosen)
     await c.message.edit_text(
         "\n".join([
             f"Запрос: {st.origin} → {st.destination} | {st.depart_date.strftime('%d.%m.%Y')}",
@@ -385,27 +521,29 @@ async def cal_set(c: CallbackQuery):
     )
     await c.answer("Ищу билеты…")
 
-    tp_task = fetch_travelpayouts(st.origin, st.destination, st.depart_date, limit=20)
-    avs_task = fetch_aviasales(st.origin, st.destination, st.depart_date, limit=20)
-    tp_res, avs_res = await asyncio.gather(tp_task, avs_task)
+    # Показываем первые результаты сразу, остальные провайдеры дорисовываются
+    updater = MessageUpdater(c.message)
 
-    st.results = merge_results(tp_res, avs_res, limit=40)
-    text = build_results_text(st)
-    start_idx = st.page * PAGE_SIZE
-    has_more = len(st.results) > start_idx + PAGE_SIZE
-    kb = results_kb(
-        visible=min(PAGE_SIZE, len(st.results) - start_idx),
-        start_index=start_idx,
-        has_more=has_more,
-        can_add_return=st.return_date is None,
-    )
-    await c.message.edit_text(text, reply_markup=kb, disable_web_page_preview=True)
+    async def show_partial(offers: List[Offer]) -> None:
+        st.results = offers
+        await updater.update(*results_view(st, loading=True))
+
+    with search_budget() as budget:
+        st.results = await progressive_merge(
+            fan_out(FareQuery(st.origin, st.destination, st.depart_date, CURRENCY, limit=20)),
+            on_partial=show_partial,
+            limit=40,
+            budget=budget.remaining(),
+        )
+    await updater.update(*results_view(st, note=budget.stale_note()), final=True)
 
 @dp.callback_query(F.data == "res:more")
 async def res_more(c: CallbackQuery):
-    st = user_state.get(c.from_user.id)
-    if not st or not st.results:
-        await c.answer("Сначала выберите маршрут и дату", show_alert=True)
+    st = await active_session(c)
+    if st is None:
+        return
+    if not st.results:
+        await c.answer(SESSION_EXPIRED_TEXT, show_alert=True)
         return
     st.page += 1
     text = build_results_text(st)
@@ -423,19 +561,21 @@ async def res_more(c: CallbackQuery):
 @dp.callback_query(F.data.startswith("buy:"))
 async def buy_ticket(c: CallbackQuery):
     idx = int(c.data.split(":", 1)[1])
-    st = user_state.get(c.from_user.id)
-    if not st or not st.results or idx >= len(st.results):
-        await c.answer("Элемент не найден", show_alert=True)
+    st = await active_session(c)
+    if st is None:
+        return
+    if idx >= len(st.results):
+        # клавиатура от прошлого поиска или сессия восстановлена без результатов
+        await c.answer(SESSION_EXPIRED_TEXT, show_alert=True)
         return
 
     st.selected_idx = idx
     choice = st.results[idx]
-    dt = choice.get("departure_at")
-    dt_str = dt[:16].replace("T", " ") if isinstance(dt, str) else "—"
+    dt_str = choice.departure_str()
 
     def build_ref_link() -> Optional[str]:
-        if choice.get("link"):
-            return choice.get("link")
+        if choice.link:
+            return choice.link
         if REF_LINK_TEMPLATE:
             dt_out = (st.depart_date or date.today()).strftime("%Y-%m-%d")
             try:
@@ -450,8 +590,8 @@ async def buy_ticket(c: CallbackQuery):
 
     txt = "\n".join([
         f"Вы выбрали вариант #{idx + 1}:",
-        f"Цена: {fmt_price(choice.get('price'))}",
-        f"Авиакомпания: {choice.get('airline', '')}",
+        f"Цена: {fmt_price(choice.price)}",
+        f"Авиакомпания: {choice.airline}",
         f"Вылет: {dt_str}",
         "",
         "Отправьте номер телефона для оформления покупки."
@@ -474,22 +614,22 @@ async def buy_ticket(c: CallbackQuery):
 @dp.message(F.contact)
 async def got_contact(m: Message):
     st = user_state.get(m.from_user.id)
-    if not st or st.selected_idx is None or not st.results:
-        await m.answer("Спасибо! Мы свяжемся с вами.")
+    if not st or st.selected_idx is None or st.selected_idx >= len(st.results):
+        # без выбранного варианта заявку собрать не из чего
+        await m.answer(SESSION_EXPIRED_TEXT)
         return
 
     choice = st.results[st.selected_idx]
     phone = m.contact.phone_number
-    dt = choice.get("departure_at")
-    dt_str = dt[:16].replace("T", " ") if isinstance(dt, str) else "—"
+    dt_str = choice.departure_str()
 
     text = "\n".join([
         "🧾 Заявка на покупку билета",
         f"Маршрут: {st.origin} → {st.destination}",
         f"Дата: {st.depart_date.strftime('%d.%m.%Y') if st.depart_date else '—'}",
         f"Вариант: #{st.selected_idx + 1}",
-        f"Цена: {fmt_price(choice.get('price'))}",
-        f"Авиакомпания: {choice.get('airline', '')}",
+        f"Цена: {fmt_price(choice.price)}",
+        f"Авиакомпания: {choice.airline}",
         f"Вылет: {dt_str}",
         f"Телефон клиента: {phone}",
         f"Пользователь: @{m.from_user.username or '-'} | {m.from_user.full_name}"
@@ -505,7 +645,10 @@ async def got_contact(m: Message):
 
 @dp.callback_query(F.data == "back:dest")
 async def back_to_dest(c: CallbackQuery):
-    st = user_state.setdefault(c.from_user.id, QueryState())
+    cancel_speculation(c.from_user.id)
+    st = await active_session(c)
+    if st is None:
+        return
     await c.message.edit_text(
         "\n".join([
             f"Вылет: {st.origin}",
@@ -517,25 +660,34 @@ async def back_to_dest(c: CallbackQuery):
 
 @dp.callback_query(F.data == "reset")
 async def reset_flow(c: CallbackQuery):
+    cancel_speculation(c.from_user.id)
     user_state[c.from_user.id] = QueryState()
     await c.message.edit_text("Новый поиск. Выбери страну вылета:", reply_markup=countries_kb(stage="origin"))
     await c.answer()
 
-@dp.callback_query(F.data == "cal:near:7")
-async def cal_near_7(c: CallbackQuery):
-    st = user_state.get(c.from_user.id)
-    if not st or not st.origin or not st.destination:
-        await c.answer("Сначала выберите маршрут", show_alert=True)
+@dp.callback_query(F.data.in_({"cal:near:7", "cal:near:30"}))
+async def cal_near(c: CallbackQuery):
+    st = await active_session(c)
+    if st is None:
+        return
+    if not st.destination:
+        await c.answer(SESSION_EXPIRED_TEXT, show_alert=True)
         return
+    span = int(c.data.rsplit(":", 1)[1])
     base = st.depart_date or (date.today() + timedelta(days=1))
-    days = [base + timedelta(days=i) for i in range(7)]
-    tasks = [fetch_travelpayouts(st.origin, st.destination, d, limit=1) for d in days]
-    results = await asyncio.gather(*tasks)
-
-    lines = ["🔥 Ближайшие 7 дат:"]
-    for d, r in zip(days, results):
-        price = r[0].get("price") if r else None
-        lines.append(f"• {d.strftime('%d.%m.%Y')} — {fmt_price(price) if price else '—'}")
+    days = [base + timedelta(days=i) for i in range(span)]
+    # Один помесячный запрос вместо запроса на каждый день
+    with search_budget() as budget:
+        prices = await range_prices(st.origin, st.destination, base, span)
+    known = [p for p in prices if p]
+    cheapest = min(known) if known else None
+
+    lines = [f"🔥 Ближайшие {span} дат:"]
+    for d, price in zip(days, prices):
+        mark = " ⭐" if price and price == cheapest else ""
+        lines.append(f"• {d.strftime('%d.%m.%Y')} — {fmt_price(price) if price else '—'}{mark}")
+    if budget.stale_note():
+        lines += ["", budget.stale_note()]
 
     kb = InlineKeyboardMarkup(
         inline_keyboard=[[
@@ -552,13 +704,15 @@ async def cal_near_7(c: CallbackQuery):
 async def cal_back(c: CallbackQuery):
     iso = c.data.split(":", 2)[2]
     target = date.fromisoformat(iso)
-    st = user_state.setdefault(c.from_user.id, QueryState())
+    st = await active_session(c)
+    if st is None:
+        return
     await c.message.edit_text(
         "\n".join([
             f"Маршрут: {st.origin} → {st.destination}",
             "Выбери дату вылета:"
         ]),
-        reply_markup=calendar_kb(target, selected=st.depart_date),
+        reply_markup=user_calendar(c.from_user.id, st, c.message, target),
     )
     await c.answer()
 
@@ -567,6 +721,21 @@ async def cal_back(c: CallbackQuery):
 # =============================
 async def main() -> None:
     log.info("Booting…")
+    await init_session()
+    shm = shm_from_env()
+    price_cache.use_shared(shm)
+    l2 = l2_from_env()
+    attach_l2(l2)
+    if l2 is not None:
+        l2.start()
+    # тёплый кэш до первого апдейта
+    await load_snapshot()
+    snapshots = asyncio.create_task(run_snapshots()) if CACHE_SNAPSHOT_PATH else None
+    user_state.use_backend(backend_from_env(), pack_state, unpack_state)
+    user_state.start_sweeper()
+    prober = asyncio.create_task(run_prober())
+    airports = sorted({iata for cities in COUNTRIES.values() for _city, iata in cities})
+    refresher = asyncio.create_task(run_refresher(airports)) if PREFETCH_ENABLED else None
     try:
         await bot.delete_webhook(drop_pending_updates=True)
         log.info("Webhook deleted (drop_pending_updates=True)")
@@ -579,7 +748,27 @@ async def main() -> None:
             await bot.send_message(MANAGERS_CHAT_ID, "✅ Бот запущен и готов принимать заявки.")
     except Exception as e:
         log.warning(f"Managers notify failed: {e}")
-    await dp.start_polling(bot, allowed_updates=["message", "callback_query"])
+    try:
+        await dp.start_polling(bot, allowed_updates=["message", "callback_query"])
+    finally:
+        prober.cancel()
+        if snapshots is not None:
+            snapshots.cancel()
+        try:
+            await save_snapshot()
+        except Exception as e:
+            log.warning(f"Cache snapshot on shutdown failed: {e}")
+        if refresher is not None:
+            refresher.cancel()
+        await user_state.stop_sweeper()
+        if user_state.backend is not None:
+            await user_state.backend.close()
+        if l2 is not None:
+            await l2.close()
+        if shm is not None:
+            price_cache.use_shared(None)
+            shm.close()
+        await close_session()
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,49 @@
+from __future__ import annotations
+from collections import defaultdict
+from typing import Dict, List
+
+# Простые in-process метрики: счётчики, текущие значения и наблюдения
+# (count/sum/max). Снимок отдаётся командой /stats в менеджерском чате.
+_counters: Dict[str, float] = defaultdict(float)
+_gauges: Dict[str, float] = {}
+_observations: Dict[str, List[float]] = {}
+
+
+def inc(name: str, value: float = 1) -> None:
+    _counters[name] += value
+
+
+def gauge(name: str, value: float) -> None:
+    _gauges[name] = value
+
+
+def observe(name: str, value: float) -> None:
+    o = _observations.get(name)
+    if o is None:
+        _observations[name] = [1, value, value]
+    else:
+        o[0] += 1
+        o[1] += value
+        if value > o[2]:
+            o[2] = value
+
+
+def snapshot() -> Dict[str, float]:
+    out: Dict[str, float] = dict(_counters)
+    out.update(_gauges)
+    for name, (cnt, total, peak) in _observations.items():
+        out[f"{name}.count"] = cnt
+        out[f"{name}.avg"] = total / cnt if cnt else 0.0
+        out[f"{name}.max"] = peak
+    return out
+
+
+def format_snapshot() -> str:
+    snap = snapshot()
+    if not snap:
+        return "Метрик пока нет."
+    lines = []
+    for k in sorted(snap):
+        v = snap[k]
+        lines.append(f"{k}: {v:.3f}" if isinstance(v, float) and not v.is_integer() else f"{k}: {int(v)}")
+    return "\n".join(lines)
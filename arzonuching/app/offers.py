@@ -0,0 +1,253 @@
+from __future__ import annotations
+import sys
+import zlib
+import heapq
+import struct
+import itertools
+from datetime import datetime, timedelta
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Tuple
+
+EPOCH = datetime(1970, 1, 1)
+NO_PRICE = 10**12  # для сортировки: предложения без цены — в конец
+
+_intern = sys.intern
+
+
+def parse_departure(value: Any) -> Optional[int]:
+    """ISO-время вылета -> секунды от эпохи по местному времени вылета.
+
+    Часовой пояс отбрасывается: на экране всегда показывается местное время
+    аэропорта, как оно пришло от API.
+    """
+    if not isinstance(value, str) or len(value) < 10:
+        return None
+    try:
+        dt = datetime.fromisoformat(value.replace("Z", ""))
+    except ValueError:
+        return None
+    return int((dt.replace(tzinfo=None) - EPOCH).total_seconds())
+
+
+def parse_price(value: Any) -> Optional[int]:
+    if value is None or value == "":
+        return None
+    try:
+        return int(round(float(value)))
+    except (TypeError, ValueError):
+        return None
+
+
+class Offer:
+    """Одно нормализованное предложение от любого провайдера.
+
+    Время вылета разбирается один раз при создании, строки авиакомпаний
+    и IATA-кодов интернируются — тысячи предложений в сессиях и кэше
+    делят одни и те же объекты строк.
+    """
+
+    __slots__ = ("price", "airline", "flight_number", "departure_ts", "origin", "destination", "transfers", "link")
+
+    def __init__(
+        self,
+        price: Optional[int],
+        airline: str = "",
+        flight_number: str = "",
+        departure_ts: Optional[int] = None,
+        origin: str = "",
+        destination: str = "",
+        transfers: int = 0,
+        link: str = "",
+    ) -> None:
+        self.price = price
+        self.airline = _intern(airline or "")
+        self.flight_number = str(flight_number or "")
+        self.departure_ts = departure_ts
+        self.origin = _intern(origin or "")
+        self.destination = _intern(destination or "")
+        self.transfers = int(transfers or 0)
+        self.link = link or ""
+
+    @classmethod
+    def from_api(cls, item: Dict[str, Any], origin: str = "", destination: str = "", link: str = "") -> "Offer":
+        # Travelpayouts и Aviasales называют поля по-разному — берём то, что есть
+        return cls(
+            price=parse_price(item.get("price") or item.get("value")),
+            airline=item.get("airline") or item.get("gate") or "",
+            flight_number=item.get("flight_number") or "",
+            departure_ts=parse_departure(item.get("departure_at") or item.get("departure_at_iso")),
+            origin=origin or item.get("origin") or "",
+            destination=destination or item.get("destination") or "",
+            transfers=item.get("transfers") or 0,
+            link=link or item.get("link") or item.get("deeplink") or "",
+        )
+
+    @property
+    def sort_price(self) -> int:
+        return self.price if self.price is not None else NO_PRICE
+
+    @property
+    def departure(self) -> Optional[datetime]:
+        if self.departure_ts is None:
+            return None
+        return EPOCH + timedelta(seconds=self.departure_ts)
+
+    def departure_str(self, fmt: str = "%Y-%m-%d %H:%M", empty: str = "—") -> str:
+        dt = self.departure
+        return dt.strftime(fmt) if dt else empty
+
+    def to_row(self) -> Tuple:
+        return (
+            self.price, self.airline, self.flight_number, self.departure_ts,
+            self.origin, self.destination, self.transfers, self.link,
+        )
+
+    @classmethod
+    def from_row(cls, row: Any) -> "Offer":
+        return cls(*row)
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, Offer) and self.to_row() == other.to_row()
+
+    def __hash__(self) -> int:
+        return hash(self.to_row())
+
+    def __repr__(self) -> str:
+        return (
+            f"Offer({self.origin}->{self.destination} {self.departure_str()} "
+            f"{self.airline}{self.flight_number} price={self.price})"
+        )
+
+
+class TopK:
+    """Потоковый отбор k самых дешёвых предложений с дедупликацией.
+
+    Держит max-кучу из не более чем k живых записей (худшая — на вершине),
+    поэтому вставка стоит O(log k), а весь поток из n предложений —
+    O(n log k) без полной сортировки. Для каждого ключа дедупликации
+    (авиакомпания, время вылета) остаётся самое дешёвое; при равной цене
+    побеждает пришедшее раньше — как при стабильной сортировке.
+    """
+
+    def __init__(self, k: int) -> None:
+        self.k = k
+        # запись: [-цена, -порядковый номер, ключ, offer]; offer=None — удалена
+        self._heap: List[list] = []
+        self._by_key: Dict[Hashable, list] = {}
+        self._seq = itertools.count()
+        self.seen = 0
+
+    def __len__(self) -> int:
+        return len(self._by_key)
+
+    @staticmethod
+    def key(offer: Offer) -> Hashable:
+        return (offer.airline, offer.departure_ts)
+
+    def _worst(self) -> list:
+        while self._heap[0][3] is None:
+            heapq.heappop(self._heap)
+        return self._heap[0]
+
+    def push(self, offer: Offer) -> bool:
+        """Учесть предложение; True — если оно попало в топ."""
+        self.seen += 1
+        if self.k <= 0:
+            return False
+        key = self.key(offer)
+        entry = [-offer.sort_price, -next(self._seq), key, offer]
+        old = self._by_key.get(key)
+        if old is not None:
+            if offer.sort_price >= -old[0]:
+                return False
+            old[3] = None
+        elif len(self._by_key) >= self.k:
+            worst = self._worst()
+            if entry[:2] <= worst[:2]:
+                return False
+            heapq.heappop(self._heap)
+            del self._by_key[worst[2]]
+        self._by_key[key] = entry
+        heapq.heappush(self._heap, entry)
+        if len(self._heap) > 2 * self.k + 16:
+            # выкинуть накопившиеся удалённые записи
+            self._heap = [e for e in self._heap if e[3] is not None]
+            heapq.heapify(self._heap)
+        return True
+
+    def extend(self, offers: Iterable[Offer]) -> None:
+        for o in offers:
+            self.push(o)
+
+    def result(self) -> List[Offer]:
+        live = sorted(self._by_key.values(), key=lambda e: (-e[0], -e[1]))
+        return [e[3] for e in live]
+
+
+# =============================
+# COMPACT SERIALIZATION
+# =============================
+# Формат: b"OF" + версия + флаг сжатия, затем (возможно zlib):
+#   число строк (H), строки (H длина + utf-8), число предложений (I),
+#   предложения по _REC: цена, время вылета, пересадки, 5 индексов строк.
+# Строки (авиакомпании, IATA, ссылки) пишутся один раз на список.
+_MAGIC = b"OF\x01"
+_REC = struct.Struct("<qqH5H")
+_NONE = -(2**63)  # отсутствующие цена/время вылета
+_COMPRESS_OVER = 512
+
+
+def pack_offers(offers: Iterable[Offer]) -> bytes:
+    strings: Dict[str, int] = {}
+
+    def idx(v: str) -> int:
+        i = strings.get(v)
+        if i is None:
+            i = strings[v] = len(strings)
+        return i
+
+    recs = []
+    for o in offers:
+        recs.append(_REC.pack(
+            _NONE if o.price is None else o.price,
+            _NONE if o.departure_ts is None else o.departure_ts,
+            o.transfers,
+            idx(o.airline), idx(o.flight_number), idx(o.origin), idx(o.destination), idx(o.link),
+        ))
+    parts = [struct.pack("<H", len(strings))]
+    for v in strings:
+        b = v.encode()
+        parts.append(struct.pack("<H", len(b)))
+        parts.append(b)
+    parts.append(struct.pack("<I", len(recs)))
+    parts += recs
+    body = b"".join(parts)
+    if len(body) > _COMPRESS_OVER:
+        return _MAGIC + b"z" + zlib.compress(body, 1)
+    return _MAGIC + b"-" + body
+
+
+def unpack_offers(blob: bytes) -> List[Offer]:
+    """Обратно к списку Offer; принимает и memoryview (разбор без копии)."""
+    if blob[:3] != _MAGIC:
+        raise ValueError("not a packed offer list")
+    body = zlib.decompress(blob[4:]) if blob[3:4] == b"z" else blob[4:]
+    pos = 2
+    (nstr,) = struct.unpack_from("<H", body, 0)
+    strings: List[str] = []
+    for _ in range(nstr):
+        (n,) = struct.unpack_from("<H", body, pos)
+        pos += 2
+        strings.append(str(body[pos:pos + n], "utf-8"))
+        pos += n
+    (count,) = struct.unpack_from("<I", body, pos)
+    pos += 4
+    out: List[Offer] = []
+    for price, dep, transfers, a, f, o, d, link in _REC.iter_unpack(body[pos:pos + count * _REC.size]):
+        out.append(Offer(
+            None if price == _NONE else price,
+            strings[a], strings[f],
+            None if dep == _NONE else dep,
+            strings[o], strings[d], transfers, strings[link],
+        ))
+    return out
+
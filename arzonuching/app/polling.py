@@ -1,7 +1,51 @@
-
 from __future__ import annotations
 import asyncio
-from .bot_logic import dp, bot
+import logging
+from .bot_logic import dp, bot, USER_STATE, pack_state, unpack_state
+from .session_backends import backend_from_env
+from .http_client import init_session, close_session
+from .providers import run_prober
+from .cache import attach_l2, price_cache
+from .l2cache import l2_from_env
+from .shmcache import shm_from_env
+from .snapshot import CACHE_SNAPSHOT_PATH, load_snapshot, run_snapshots, save_snapshot
+
+log = logging.getLogger("avia-bot")
+
+
+async def main() -> None:
+    await init_session()
+    shm = shm_from_env()
+    price_cache.use_shared(shm)
+    l2 = l2_from_env()
+    attach_l2(l2)
+    if l2 is not None:
+        l2.start()
+    # тёплый кэш до первого апдейта
+    await load_snapshot()
+    snapshots = asyncio.create_task(run_snapshots()) if CACHE_SNAPSHOT_PATH else None
+    USER_STATE.use_backend(backend_from_env(), pack_state, unpack_state)
+    USER_STATE.start_sweeper()
+    prober = asyncio.create_task(run_prober())
+    try:
+        await dp.start_polling(bot)
+    finally:
+        prober.cancel()
+        if snapshots is not None:
+            snapshots.cancel()
+        try:
+            await save_snapshot()
+        except Exception as e:
+            log.warning(f"Cache snapshot on shutdown failed: {e}")
+        await USER_STATE.stop_sweeper()
+        if USER_STATE.backend is not None:
+            await USER_STATE.backend.close()
+        if l2 is not None:
+            await l2.close()
+        if shm is not None:
+            price_cache.use_shared(None)
+            shm.close()
+        await close_session()
 
 if __name__ == "__main__":
-    asyncio.run(dp.start_polling(bot))
+    asyncio.run(main())
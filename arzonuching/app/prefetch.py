@@ -0,0 +1,250 @@
+from __future__ import annotations
+import os
+import math
+import time
+import asyncio
+import logging
+from datetime import date, timedelta
+from typing import Awaitable, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from . import metrics
+from .cache import price_cache
+from .price_calendar import month_key, refresh_month
+from .providers import FareQuery, enabled_providers
+from .ratelimit import PREFETCH, request_priority
+from .ttl_policy import ttl_policy
+
+log = logging.getLogger("avia-bot.prefetch")
+
+# =============================
+# ENV
+# =============================
+CURRENCY = os.getenv("CURRENCY", "uzs").lower()
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "1") == "1"
+PREFETCH_INTERVAL = float(os.getenv("PREFETCH_INTERVAL", "300"))         # период обхода, сек
+PREFETCH_HORIZON_DAYS = int(os.getenv("PREFETCH_HORIZON_DAYS", "60"))
+PREFETCH_MAX_CELLS = int(os.getenv("PREFETCH_MAX_CELLS", "40"))          # ячеек маршрут×дата за обход
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", "2"))
+PREFETCH_REFRESH_AHEAD = float(os.getenv("PREFETCH_REFRESH_AHEAD", "120"))  # обновлять за N сек до протухания
+PREFETCH_SPECULATIVE_DATES = int(os.getenv("PREFETCH_SPECULATIVE_DATES", "3"))  # дат при выборе направления
+DEMAND_HALF_LIFE = float(os.getenv("DEMAND_HALF_LIFE", str(6 * 3600)))    # полураспад счётчиков спроса, сек
+QUERY_LIMIT = 20  # как в интерактивном поиске — чтобы совпадали ключи кэша
+
+Route = Tuple[str, str]
+
+
+class DemandTracker:
+    """Затухающие счётчики запросов по маршрутам и ячейкам маршрут×дата.
+
+    Счётчик уменьшается вдвое за DEMAND_HALF_LIFE, поэтому вчерашний
+    всплеск не держит маршрут «горячим» вечно.
+    """
+
+    def __init__(self, half_life: float = DEMAND_HALF_LIFE) -> None:
+        self.decay = math.log(2) / half_life
+        # ключ -> (счётчик на момент ts, ts)
+        self._counts: Dict[Hashable, Tuple[float, float]] = {}
+
+    def _bump(self, key: Hashable, weight: float, now: float) -> None:
+        self._counts[key] = (self._score(key, now) + weight, now)
+
+    def _score(self, key: Hashable, now: float) -> float:
+        item = self._counts.get(key)
+        if item is None:
+            return 0.0
+        return item[0] * math.exp(-self.decay * (now - item[1]))
+
+    def record(self, origin: str, destination: str, day: Optional[date] = None, weight: float = 1.0) -> None:
+        now = time.time()
+        route = (origin.upper(), destination.upper())
+        self._bump(route, weight, now)
+        if day is not None:
+            self._bump((*route, day.toordinal()), weight, now)
+
+    def route_score(self, origin: str, destination: str) -> float:
+        return self._score((origin.upper(), destination.upper()), time.time())
+
+    def cell_score(self, origin: str, destination: str, day: date) -> float:
+        return self._score((origin.upper(), destination.upper(), day.toordinal()), time.time())
+
+    def routes(self) -> List[Tuple[Route, float]]:
+        now = time.time()
+        out = [(k, self._score(k, now)) for k in self._counts if len(k) == 2]
+        return sorted(out, key=lambda kv: kv[1], reverse=True)
+
+    def prune(self, min_score: float = 0.01) -> int:
+        """Забыть ключи, чей счётчик затух до нуля, и прошедшие даты."""
+        now = time.time()
+        today = date.today().toordinal()
+        dead = [
+            k for k in self._counts
+            if self._score(k, now) < min_score or (len(k) == 3 and k[2] < today)
+        ]
+        for k in dead:
+            del self._counts[k]
+        return len(dead)
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+    def items(self) -> List[Tuple[Hashable, float, float]]:
+        """(ключ, счётчик, момент замера) — для снимка."""
+        return [(k, score, ts) for k, (score, ts) in self._counts.items()]
+
+    def restore(self, key: Hashable, score: float, ts: float) -> None:
+        """Вернуть счётчик из снимка; затухание продолжится от исходного ts."""
+        now = time.time()
+        self._counts[key] = (self._score(key, now) + score * math.exp(-self.decay * (now - ts)), now)
+
+
+demand = DemandTracker()
+# популярные маршруты держим в кэше свежее
+ttl_policy.popularity = demand.route_score
+
+
+def hot_cells(
+    airports: Iterable[str],
+    tracker: DemandTracker = demand,
+    horizon: int = PREFETCH_HORIZON_DAYS,
+    limit: int = PREFETCH_MAX_CELLS,
+) -> List[Tuple[float, str, str, date]]:
+    """Самые востребованные ячейки маршрут×дата на ближайшие horizon дней.
+
+    Вес ячейки — спрос на саму дату плюс спрос на маршрут, распределённый
+    по датам с убыванием к дальним (ближние даты ищут чаще).
+    Маршруты вне списка аэропортов и без спроса не рассматриваются.
+    """
+    known = set(airports)
+    cells: List[Tuple[float, str, str, date]] = []
+    for (origin, destination), route_score in tracker.routes():
+        if origin not in known or destination not in known or route_score <= 0:
+            continue
+        cells += _route_cells(origin, destination, route_score, tracker, horizon)
+    cells.sort(key=lambda c: c[0], reverse=True)
+    return cells[:limit]
+
+
+def _route_cells(
+    origin: str, destination: str, route_score: float, tracker: DemandTracker, horizon: int
+) -> List[Tuple[float, str, str, date]]:
+    today = date.today()
+    out = []
+    for i in range(1, horizon + 1):
+        d = today + timedelta(days=i)
+        out.append((tracker.cell_score(origin, destination, d) + route_score / (1 + i / 7), origin, destination, d))
+    return out
+
+
+def likely_dates(
+    origin: str, destination: str, n: int = PREFETCH_SPECULATIVE_DATES, tracker: DemandTracker = demand
+) -> List[date]:
+    """Даты, которые пользователь скорее всего выберет: самые спрашиваемые
+    на этом маршруте, а без истории — ближайшие."""
+    route_score = max(tracker.route_score(origin, destination), 1.0)
+    cells = _route_cells(origin.upper(), destination.upper(), route_score, tracker, PREFETCH_HORIZON_DAYS)
+    cells.sort(key=lambda c: c[0], reverse=True)
+    return [c[3] for c in cells[:n]]
+
+
+def _needs_refresh(key: Tuple) -> bool:
+    return price_cache.ttl_left(key) <= PREFETCH_REFRESH_AHEAD
+
+
+async def refresh_cells(
+    cells: List[Tuple[float, str, str, date]],
+    currency: str = CURRENCY,
+    extra_months: Iterable[Tuple[str, str, int, int]] = (),
+) -> int:
+    """Обновить в кэше ячейки и месячные календари их маршрутов; вернуть число запросов."""
+    providers = [p for p in enabled_providers() if p.health.mode() == "ok"]
+    # фабрики, а не корутины: отменённый до старта обход не оставит неожиданных корутин
+    jobs: List[Callable[[], Awaitable[object]]] = []
+    fresh = 0
+    months = set(extra_months)
+    for _score, origin, destination, d in cells:
+        months.add((origin, destination, d.year, d.month))
+        q = FareQuery(origin, destination, d, currency, limit=QUERY_LIMIT)
+        for p in providers:
+            if _needs_refresh(p.cache_key(q)):
+                jobs.append(lambda p=p, q=q: p.refresh(q))
+            else:
+                fresh += 1
+    for origin, destination, y, m in sorted(months):
+        if _needs_refresh(month_key(origin, destination, y, m, currency)):
+            jobs.append(lambda o=origin, d=destination, y=y, m=m: refresh_month(o, d, y, m, currency))
+        else:
+            fresh += 1
+    if fresh:
+        metrics.inc("prefetch.fresh", fresh)
+    if not jobs:
+        return 0
+
+    sem = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+
+    async def run(job) -> None:
+        async with sem:
+            try:
+                await job()
+                metrics.inc("prefetch.refreshed")
+            except Exception as e:
+                metrics.inc("prefetch.failed")
+                log.debug(f"Prefetch failed: {e}")
+
+    # в очереди лимитера фоновые запросы уступают пользователям
+    with request_priority(PREFETCH):
+        await asyncio.gather(*(run(j) for j in jobs))
+    return len(jobs)
+
+
+async def run_refresher(airports: List[str], interval: float = PREFETCH_INTERVAL) -> None:
+    """Фоновый цикл: держать тёплыми самые востребованные ячейки."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            demand.prune()
+            cells = hot_cells(airports)
+            t0 = time.perf_counter()
+            sent = await refresh_cells(cells)
+            metrics.observe("prefetch.cycle_ms", (time.perf_counter() - t0) * 1000)
+            metrics.gauge("prefetch.tracked", len(demand))
+            if sent:
+                log.info("Prefetch: %s hot cells, %s upstream refreshes", len(cells), sent)
+        except Exception as e:
+            log.warning(f"Prefetch loop failed: {e}")
+
+
+# =============================
+# SPECULATIVE PREFETCH
+# =============================
+_speculative: Dict[int, asyncio.Task] = {}
+
+
+def speculate(user_id: int, origin: str, destination: str, month: date) -> None:
+    """Пользователь выбрал маршрут и смотрит на календарь — заранее
+    подгрузить вероятные даты и показанный месяц.
+
+    Прежняя догрузка этого пользователя отменяется. Отмена не обрывает
+    запрос, к которому уже присоединился интерактивный поиск.
+    """
+    if not PREFETCH_ENABLED or not origin or not destination:
+        return
+    cancel_speculation(user_id)
+    cells = [(0.0, origin, destination, d) for d in likely_dates(origin, destination)]
+    task = asyncio.create_task(refresh_cells(cells, extra_months=[(origin, destination, month.year, month.month)]))
+    _speculative[user_id] = task
+    metrics.inc("prefetch.speculative.started")
+
+    def done(t: asyncio.Task) -> None:
+        if _speculative.get(user_id) is t:
+            del _speculative[user_id]
+        if not t.cancelled() and t.exception() is not None:
+            log.debug(f"Speculative prefetch failed: {t.exception()}")
+
+    task.add_done_callback(done)
+
+
+def cancel_speculation(user_id: int) -> None:
+    task = _speculative.pop(user_id, None)
+    if task is not None and not task.done():
+        task.cancel()
+        metrics.inc("prefetch.speculative.cancelled")
@@ -0,0 +1,139 @@
+from __future__ import annotations
+import os
+import asyncio
+import calendar
+import logging
+from array import array
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+
+from .http_client import get_session
+from .cache import cached_fetch, price_cache, price_key, refresh
+from .providers import get_provider
+from .resilience import call_with_retries
+
+log = logging.getLogger("avia-bot.calendar")
+
+CURRENCY = os.getenv("CURRENCY", "uzs").lower()
+
+# Ключ провайдера в кэше (TTL — CACHE_TTL_CALENDAR)
+CALENDAR_PROVIDER = "tp_calendar"
+
+GROUPED_PRICES_URL = "https://api.travelpayouts.com/aviasales/v3/grouped_prices"
+
+# Месячная матрица: array("l") длиной в число дней месяца,
+# элемент [day-1] — минимальная цена на дату, 0 — цены нет.
+MonthPrices = array
+
+
+def month_key(origin: str, destination: str, year: int, month: int, currency: str = CURRENCY) -> Tuple:
+    return price_key(CALENDAR_PROVIDER, origin, destination, f"{year:04d}-{month:02d}", currency)
+
+
+async def _request_month(
+    origin: str, destination: str, year: int, month: int, currency: str, session: Optional[aiohttp.ClientSession]
+) -> MonthPrices:
+    params = {
+        "origin": origin,
+        "destination": destination,
+        "departure_at": f"{year:04d}-{month:02d}",
+        "group_by": "departure_at",
+        "currency": currency,
+    }
+    s = session or get_session()
+    tp = get_provider("travelpayouts")
+
+    async def once() -> dict:
+        # ключи и их квоты общие с провайдером travelpayouts
+        token = await tp.acquire()
+        async with s.get(GROUPED_PRICES_URL, params={**params, "token": token.value if token else ""}) as r:
+            if r.status != 200:
+                log.debug("grouped_prices %s%s %04d-%02d: status %s", origin, destination, year, month, r.status)
+                raise tp.upstream_error(r.status, r.headers, token)
+            if token is not None:
+                tp.tokens.on_response(token, r.status, r.headers)
+            return await r.json(content_type=None)
+
+    # тот же апстрим, что у провайдера travelpayouts, — общий предохранитель
+    payload = await call_with_retries(CALENDAR_PROVIDER, once, tp.breaker)
+
+    data = payload.get("data") or {}
+    if not isinstance(data, dict) or not data:
+        return array("l")
+    ndays = calendar.monthrange(year, month)[1]
+    prices = array("l", [0] * ndays)
+    for day_iso, item in data.items():
+        try:
+            d = date.fromisoformat(day_iso[:10])
+            price = int(item.get("price") or 0)
+        except (ValueError, TypeError, AttributeError):
+            continue
+        if d.year == year and d.month == month and price > 0:
+            i = d.day - 1
+            if not prices[i] or price < prices[i]:
+                prices[i] = price
+    return prices
+
+
+async def month_prices(
+    origin: str,
+    destination: str,
+    year: int,
+    month: int,
+    currency: str = CURRENCY,
+    session: Optional[aiohttp.ClientSession] = None,
+) -> MonthPrices:
+    """Цены на каждый день месяца одним запросом (через кэш)."""
+    if not get_provider("travelpayouts").enabled():
+        return array("l")
+    key = month_key(origin, destination, year, month, currency)
+    return await cached_fetch(
+        CALENDAR_PROVIDER,
+        key,
+        lambda: _request_month(origin, destination, year, month, currency, session),
+        empty=lambda: array("l"),
+    )
+
+
+async def refresh_month(
+    origin: str, destination: str, year: int, month: int, currency: str = CURRENCY
+) -> MonthPrices:
+    """Обновить месячную матрицу в кэше мимо проверки свежести."""
+    key = month_key(origin, destination, year, month, currency)
+    return await refresh(CALENDAR_PROVIDER, key, lambda: _request_month(origin, destination, year, month, currency, None))
+
+
+def cached_month(origin: str, destination: str, year: int, month: int, currency: str = CURRENCY) -> Optional[MonthPrices]:
+    """Матрица из кэша без похода в апстрим; None — если её там нет."""
+    key = month_key(origin, destination, year, month, currency)
+    if key not in price_cache:
+        return None
+    return price_cache.get(key)
+
+
+def _months_between(start: date, end: date) -> List[Tuple[int, int]]:
+    months: List[Tuple[int, int]] = []
+    y, m = start.year, start.month
+    while (y, m) <= (end.year, end.month):
+        months.append((y, m))
+        y, m = (y + 1, 1) if m == 12 else (y, m + 1)
+    return months
+
+
+async def range_prices(
+    origin: str, destination: str, start: date, days: int, currency: str = CURRENCY
+) -> List[Optional[int]]:
+    """Цены на days дней начиная со start; месяцы запрашиваются параллельно."""
+    end = start + timedelta(days=days - 1)
+    months = _months_between(start, end)
+    arrays = await asyncio.gather(*[month_prices(origin, destination, y, m, currency) for y, m in months])
+    by_month: Dict[Tuple[int, int], MonthPrices] = dict(zip(months, arrays))
+    out: List[Optional[int]] = []
+    for i in range(days):
+        d = start + timedelta(days=i)
+        arr = by_month.get((d.year, d.month))
+        v = arr[d.day - 1] if arr else 0
+        out.append(v or None)
+    return out
@@ -0,0 +1,98 @@
+from __future__ import annotations
+import os
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable, Iterable, List, Optional
+
+from aiogram.types import InlineKeyboardMarkup, Message
+
+from . import metrics
+from .budget import SEARCH_BUDGET
+from .offers import Offer, TopK
+
+log = logging.getLogger("avia-bot.progressive")
+
+# =============================
+# ENV
+# =============================
+EDIT_MIN_INTERVAL = float(os.getenv("EDIT_MIN_INTERVAL", "1.0"))   # не чаще раза в N сек на сообщение
+# после дедлайна бюджета источникам даётся ещё столько сек — отдать протухшее из кэша
+PROGRESSIVE_GRACE = float(os.getenv("PROGRESSIVE_GRACE", "0.25"))
+
+
+class MessageUpdater:
+    """Правки одного сообщения: без повторов одинакового текста и не чаще min_interval."""
+
+    def __init__(self, message: Message, min_interval: float = EDIT_MIN_INTERVAL) -> None:
+        self.message = message
+        self.min_interval = min_interval
+        self._last: Optional[tuple] = None
+        self._last_at = 0.0
+
+    async def update(self, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None, final: bool = False) -> bool:
+        sig = (text, reply_markup.model_dump_json() if reply_markup else None)
+        if sig == self._last:
+            metrics.inc("progressive.noop_skipped")
+            return False
+        wait = self.min_interval - (time.monotonic() - self._last_at)
+        if wait > 0:
+            if not final:
+                # промежуточный кадр можно пропустить — следующий всё равно придёт
+                metrics.inc("progressive.rate_skipped")
+                return False
+            await asyncio.sleep(wait)
+        try:
+            await self.message.edit_text(text, reply_markup=reply_markup, disable_web_page_preview=True)
+        except Exception as e:
+            if final:
+                raise
+            # flood control, сеть, «сообщение нельзя изменить» — промежуточный
+            # кадр не должен обрывать поиск
+            log.warning(f"Partial edit failed: {e}")
+            metrics.inc("progressive.edit_failed")
+            return False
+        self._last = sig
+        self._last_at = time.monotonic()
+        metrics.inc("progressive.edits")
+        return True
+
+
+async def progressive_merge(
+    sources: Iterable[Awaitable[List[Offer]]],
+    on_partial: Callable[[List[Offer]], Awaitable[None]],
+    limit: int = 40,
+    budget: float = SEARCH_BUDGET,
+    grace: float = PROGRESSIVE_GRACE,
+) -> List[Offer]:
+    """Сливать ответы провайдеров по мере готовности.
+
+    После каждого ответа, пока остальные ещё грузятся, вызывается
+    on_partial с текущим топом. Через budget + grace секунд незавершённые
+    запросы отменяются и возвращается то, что уже собрано. grace нужен,
+    чтобы cached_fetch, сдавшийся ровно по дедлайну бюджета, успел
+    вернуть запасной ответ из кэша.
+    """
+    top = TopK(limit)
+    pending = {asyncio.ensure_future(src) for src in sources}
+    deadline = time.monotonic() + budget + grace
+    try:
+        while pending:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                metrics.inc("progressive.stragglers_dropped", len(pending))
+                break
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            changed = False
+            for task in done:
+                if task.exception() is not None:
+                    log.warning(f"Provider failed: {task.exception()}")
+                    continue
+                for offer in task.result():
+                    changed = top.push(offer) or changed
+            if changed and pending:
+                await on_partial(top.result())
+    finally:
+        for task in pending:
+            task.cancel()
+    return top.result()
@@ -0,0 +1,391 @@
+from __future__ import annotations
+import os
+import time
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import date, timedelta
+from typing import Any, Awaitable, Dict, List, Optional, Tuple
+
+import aiohttp
+
+from . import metrics
+from .cache import cached_fetch, price_cache, price_key, refresh
+from .http_client import get_session
+from .offers import Offer
+from .ratelimit import PREFETCH, RATE_LIMIT_BURST, RATE_LIMIT_RPS, bucket, request_priority
+from .resilience import CircuitBreaker, UpstreamError, call_with_retries, parse_retry_after
+from .tokens import TP_TOKENS, ApiToken, TokenPool
+
+log = logging.getLogger("avia-bot.providers")
+
+# =============================
+# ENV
+# =============================
+AVS_TOKEN = os.getenv("AVS_API_TOKEN", "")
+
+# Адаптивный выбор провайдеров
+HEALTH_ALPHA = float(os.getenv("PROVIDER_HEALTH_ALPHA", "0.2"))              # вес нового замера в EWMA
+HEALTH_MIN_SAMPLES = int(os.getenv("PROVIDER_HEALTH_MIN_SAMPLES", "5"))
+HEALTH_SLOW_MS = float(os.getenv("PROVIDER_SLOW_MS", "4000"))                # медленнее — только фоном
+HEALTH_MAX_ERROR_RATE = float(os.getenv("PROVIDER_MAX_ERROR_RATE", "0.5"))   # чаще ошибается — выключен
+HEALTH_PROBE_INTERVAL = float(os.getenv("PROVIDER_PROBE_INTERVAL", "60"))
+HEALTH_PROBE_ROUTE = os.getenv("PROVIDER_PROBE_ROUTE", "TAS-IST")
+
+
+@dataclass(frozen=True)
+class FareQuery:
+    origin: str
+    destination: str
+    day: date
+    currency: str
+    limit: int = 20
+
+
+class ProviderError(UpstreamError):
+    pass
+
+
+class ProviderStats:
+    """Счётчики одного провайдера; то же самое дублируется в metrics."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.calls = 0
+        self.errors = 0
+        self.offers = 0
+        self.total_ms = 0.0
+
+    def record(self, ms: float, offers: int = 0, error: bool = False) -> None:
+        self.calls += 1
+        self.total_ms += ms
+        self.offers += offers
+        metrics.inc(f"provider.{self.name}.calls")
+        metrics.observe(f"provider.{self.name}.latency_ms", ms)
+        if error:
+            self.errors += 1
+            metrics.inc(f"provider.{self.name}.errors")
+        else:
+            metrics.observe(f"provider.{self.name}.offers", offers)
+
+    def summary(self) -> str:
+        avg = self.total_ms / self.calls if self.calls else 0.0
+        err = self.errors / self.calls if self.calls else 0.0
+        return f"{self.name}: {self.calls} запросов, {avg:.0f} мс, ошибок {err:.0%}, предложений {self.offers}"
+
+
+class ProviderHealth:
+    """Скользящие (EWMA) задержка и доля ошибок провайдера.
+
+    mode():
+      "ok"    — участвует в интерактивном поиске;
+      "slow"  — запрос уходит только в фон, чтобы прогреть кэш;
+      "down"  — не вызывается, пока проба не покажет, что он ожил.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.latency_ms = 0.0
+        self.error_rate = 0.0
+        self.samples = 0
+        self.last_probe = 0.0
+        self._mode = "ok"
+
+    def record(self, ms: float, error: bool) -> None:
+        a = HEALTH_ALPHA if self.samples else 1.0
+        self.latency_ms += a * (ms - self.latency_ms)
+        self.error_rate += a * ((1.0 if error else 0.0) - self.error_rate)
+        self.samples += 1
+        mode = self.mode()
+        if mode != self._mode:
+            log.warning("Provider %s: %s -> %s (%.0f ms, errors %.0f%%)",
+                        self.name, self._mode, mode, self.latency_ms, self.error_rate * 100)
+            metrics.inc(f"provider.{self.name}.mode_changes")
+            self._mode = mode
+        metrics.gauge(f"provider.{self.name}.ewma_latency_ms", self.latency_ms)
+        metrics.gauge(f"provider.{self.name}.ewma_error_rate", self.error_rate)
+
+    def mode(self) -> str:
+        if self.samples < HEALTH_MIN_SAMPLES:
+            return "ok"
+        if self.error_rate > HEALTH_MAX_ERROR_RATE:
+            return "down"
+        if self.latency_ms > HEALTH_SLOW_MS:
+            return "slow"
+        return "ok"
+
+    def probe_due(self) -> bool:
+        return self.mode() != "ok" and time.monotonic() - self.last_probe >= HEALTH_PROBE_INTERVAL
+
+
+class Provider:
+    """Источник цен. Наследник описывает, как строить запрос и как разбирать ответ.
+
+    Таймаут, ограничение параллельности и частоты, кэш и статистика — общие.
+    """
+
+    name = "base"
+
+    def __init__(
+        self,
+        timeout: float = 20,
+        concurrency: int = 10,
+        rate: float = RATE_LIMIT_RPS,
+        burst: float = RATE_LIMIT_BURST,
+        tokens: Optional[TokenPool] = None,
+    ) -> None:
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.limiter = bucket(self.name, rate, burst)
+        # с пулом ключей частоту ограничивают вёдра отдельных ключей
+        self.tokens = tokens
+        self.stats = ProviderStats(self.name)
+        self.health = ProviderHealth(self.name)
+        self.breaker = CircuitBreaker(self.name)
+        self._sem: Optional[asyncio.Semaphore] = None
+
+    def enabled(self) -> bool:
+        return True
+
+    def request(self, q: FareQuery, token: Optional[ApiToken] = None) -> Tuple[str, Dict[str, Any], Dict[str, str]]:
+        """(url, query-параметры, заголовки) для запроса q; token — ключ из пула, если он есть."""
+        raise NotImplementedError
+
+    async def acquire(self) -> Optional[ApiToken]:
+        """Дождаться своей очереди в лимитере; вернуть выбранный ключ пула."""
+        if self.tokens:
+            return await self.tokens.acquire()
+        await self.limiter.acquire()
+        return None
+
+    def upstream_error(self, status: int, headers: Any, token: Optional[ApiToken]) -> ProviderError:
+        """Ответ не 200: снять ключ с ротации при 429/403 и решить, повторять ли."""
+        retry_after = parse_retry_after(headers.get("Retry-After"))
+        retryable = status == 429 or status >= 500
+        fault = True
+        if token is not None and self.tokens is not None:
+            self.tokens.on_response(token, status, headers)
+            if status in (403, 429):
+                # квота одного ключа: он уже на паузе, предохранитель не трогаем
+                fault = False
+                if self.tokens.available():
+                    # другой ключ можно пробовать сразу
+                    retryable, retry_after = True, None
+        return ProviderError(
+            f"{self.name}: HTTP {status}", status=status, retryable=retryable, retry_after=retry_after, upstream_fault=fault
+        )
+
+    def normalize(self, payload: Any, q: FareQuery) -> List[Offer]:
+        data = payload.get("data", []) if isinstance(payload, dict) else []
+        if not isinstance(data, list):
+            return []
+        return [Offer.from_api(it, q.origin, q.destination) for it in data[:q.limit]]
+
+    async def fetch(self, q: FareQuery, session: Optional[aiohttp.ClientSession] = None) -> List[Offer]:
+        """Запрос в апстрим мимо кэша: с повторами и предохранителем."""
+        return await call_with_retries(self.name, lambda: self._fetch_once(q, session), self.breaker)
+
+    async def _fetch_once(self, q: FareQuery, session: Optional[aiohttp.ClientSession]) -> List[Offer]:
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.concurrency)
+        s = session or get_session()
+        # каждая попытка (включая повторы) расходует квоту апстрима
+        token = await self.acquire()
+        url, params, headers = self.request(q, token)
+        async with self._sem:
+            t0 = time.perf_counter()
+            try:
+                async with s.get(url, params=params, headers=headers, timeout=aiohttp.ClientTimeout(total=self.timeout)) as r:
+                    if r.status != 200:
+                        raise self.upstream_error(r.status, r.headers, token)
+                    if token is not None:
+                        self.tokens.on_response(token, r.status, r.headers)
+                    payload = await r.json(content_type=None)
+                offers = self.normalize(payload, q)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                ms = (time.perf_counter() - t0) * 1000
+                self.stats.record(ms, error=True)
+                self.health.record(ms, error=True)
+                raise ProviderError(f"{self.name}: {e.__class__.__name__} {e}", retryable=True) from e
+            except Exception:
+                ms = (time.perf_counter() - t0) * 1000
+                self.stats.record(ms, error=True)
+                self.health.record(ms, error=True)
+                raise
+        ms = (time.perf_counter() - t0) * 1000
+        self.stats.record(ms, offers=len(offers))
+        self.health.record(ms, error=False)
+        return offers
+
+    def cache_key(self, q: FareQuery) -> Tuple:
+        return price_key(self.name, q.origin, q.destination, q.day, q.currency, q.limit)
+
+    async def search(self, q: FareQuery, session: Optional[aiohttp.ClientSession] = None) -> List[Offer]:
+        """Запрос через кэш и склейку одинаковых запросов."""
+        return await cached_fetch(self.name, self.cache_key(q), lambda: self.fetch(q, session))
+
+    async def refresh(self, q: FareQuery, session: Optional[aiohttp.ClientSession] = None) -> List[Offer]:
+        """Обновить запись кэша для q, не дожидаясь её протухания."""
+        return await refresh(self.name, self.cache_key(q), lambda: self.fetch(q, session))
+
+
+class TravelpayoutsProvider(Provider):
+    name = "travelpayouts"
+    URL = "https://api.travelpayouts.com/aviasales/v3/prices_for_dates"
+
+    def enabled(self) -> bool:
+        return bool(self.tokens)
+
+    def request(self, q: FareQuery, token: Optional[ApiToken] = None) -> Tuple[str, Dict[str, Any], Dict[str, str]]:
+        params = {
+            "origin": q.origin,
+            "destination": q.destination,
+            "departure_at": q.day.strftime("%Y-%m-%d"),
+            "currency": q.currency,
+            "limit": q.limit,
+            "page": 1,
+            "sorting": "price",
+            "direct": "false",
+            "unique": "false",
+            "one_way": "true",
+            "token": token.value if token else "",
+        }
+        return self.URL, params, {}
+
+
+class AviasalesProvider(Provider):
+    name = "aviasales"
+    URL = "https://api.aviasales.com/v3/prices_for_dates"
+
+    def enabled(self) -> bool:
+        return bool(AVS_TOKEN)
+
+    def request(self, q: FareQuery, token: Optional[ApiToken] = None) -> Tuple[str, Dict[str, Any], Dict[str, str]]:
+        params = {
+            "origin": q.origin,
+            "destination": q.destination,
+            "departure_at": q.day.strftime("%Y-%m-%d"),
+            "currency": q.currency,
+            "limit": q.limit,
+            "sorting": "price",
+            "one_way": "true",
+        }
+        return self.URL, params, {"X-Access-Token": AVS_TOKEN}
+
+
+# =============================
+# REGISTRY
+# =============================
+PROVIDERS: Dict[str, Provider] = {}
+
+
+def register(provider: Provider) -> Provider:
+    PROVIDERS[provider.name] = provider
+    return provider
+
+
+def get_provider(name: str) -> Provider:
+    return PROVIDERS[name]
+
+
+def enabled_providers() -> List[Provider]:
+    return [p for p in PROVIDERS.values() if p.enabled()]
+
+
+async def safe_search(provider: Provider, q: FareQuery, session: Optional[aiohttp.ClientSession] = None) -> List[Offer]:
+    """Поиск у одного провайдера; ошибка превращается в пустой список."""
+    try:
+        return await provider.search(q, session)
+    except Exception as e:
+        log.warning(f"{provider.name} search failed: {e}")
+        return []
+
+
+_background: set = set()
+
+
+async def _low_priority(coro: Awaitable[Any]) -> Any:
+    with request_priority(PREFETCH):
+        return await coro
+
+
+def _spawn(coro: Awaitable[Any]) -> None:
+    """Фоновый запрос: в очереди лимитера уступает интерактивным."""
+    task = asyncio.ensure_future(_low_priority(coro))
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+
+def fan_out(q: FareQuery, session: Optional[aiohttp.ClientSession] = None) -> List[Awaitable[List[Offer]]]:
+    """По корутине на каждый здоровый провайдер — для gather/progressive_merge.
+
+    Медленные провайдеры запрашиваются в фоне (ответ попадёт в кэш и
+    пригодится следующему поиску), упавшие пропускаются. Если здоровых
+    нет совсем, спрашиваем всех — пустой ответ хуже медленного.
+    """
+    providers = enabled_providers()
+    healthy = [p for p in providers if p.health.mode() == "ok"]
+    if not healthy:
+        return [safe_search(p, q, session) for p in providers]
+    for p in providers:
+        mode = p.health.mode()
+        if mode != "ok" and p.cache_key(q) in price_cache:
+            # свежий ответ уже в кэше — он бесплатный, берём
+            healthy.append(p)
+        elif mode == "slow":
+            metrics.inc(f"provider.{p.name}.background_only")
+            _spawn(safe_search(p, q, session))
+        elif mode == "down":
+            metrics.inc(f"provider.{p.name}.skipped")
+    return [safe_search(p, q, session) for p in healthy]
+
+
+async def probe_providers() -> None:
+    """Пробный запрос мимо кэша к каждому нездоровому провайдеру."""
+    origin, destination = HEALTH_PROBE_ROUTE.split("-", 1)
+    q = FareQuery(origin, destination, date.today() + timedelta(days=14), "usd", limit=1)
+    for p in enabled_providers():
+        if not p.health.probe_due():
+            continue
+        p.health.last_probe = time.monotonic()
+        metrics.inc(f"provider.{p.name}.probes")
+        try:
+            with request_priority(PREFETCH):
+                await p.fetch(q)
+        except Exception as e:
+            log.info(f"Probe {p.name} failed: {e}")
+
+
+async def run_prober(interval: float = HEALTH_PROBE_INTERVAL) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await probe_providers()
+        except Exception as e:
+            log.warning(f"Provider probe loop failed: {e}")
+
+
+def stats_summary() -> str:
+    lines = []
+    for p in PROVIDERS.values():
+        lines.append(f"{p.stats.summary()} [{p.health.mode()}, breaker {p.breaker.state}, очередь {p.limiter.queue_depth}]")
+        if p.tokens:
+            lines.append(p.tokens.summary())
+    return "\n".join(lines)
+
+
+_TP_RATE = float(os.getenv("RATE_LIMIT_RPS_TRAVELPAYOUTS", str(RATE_LIMIT_RPS)))
+_TP_BURST = float(os.getenv("RATE_LIMIT_BURST_TRAVELPAYOUTS", str(RATE_LIMIT_BURST)))
+register(TravelpayoutsProvider(
+    timeout=float(os.getenv("PROVIDER_TIMEOUT_TRAVELPAYOUTS", "20")),
+    concurrency=int(os.getenv("PROVIDER_CONCURRENCY_TRAVELPAYOUTS", "10")),
+    rate=_TP_RATE,
+    burst=_TP_BURST,
+    tokens=TokenPool("travelpayouts", TP_TOKENS, rate=_TP_RATE, burst=_TP_BURST),
+))
+register(AviasalesProvider(
+    timeout=float(os.getenv("PROVIDER_TIMEOUT_AVIASALES", "20")),
+    concurrency=int(os.getenv("PROVIDER_CONCURRENCY_AVIASALES", "10")),
+    rate=float(os.getenv("RATE_LIMIT_RPS_AVIASALES", str(RATE_LIMIT_RPS))),
+    burst=float(os.getenv("RATE_LIMIT_BURST_AVIASALES", str(RATE_LIMIT_BURST))),
+))
@@ -0,0 +1,138 @@
+from __future__ import annotations
+import os
+import time
+import heapq
+import asyncio
+import itertools
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from . import metrics
+from .budget import current_budget
+from .resilience import UpstreamError
+
+# =============================
+# ENV
+# =============================
+RATE_LIMIT_RPS = float(os.getenv("RATE_LIMIT_RPS", "5"))           # запросов в секунду на провайдера/токен
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "10"))
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "5"))  # дольше в очереди не стоим, сек
+
+# Классы приоритета: меньше — важнее
+INTERACTIVE = 0
+PREFETCH = 1
+
+_priority: ContextVar[int] = ContextVar("request_priority", default=INTERACTIVE)
+
+
+class RateLimited(UpstreamError):
+    """Место в очереди не освободилось за max_wait (апстрим не трогали)."""
+
+
+def current_priority() -> int:
+    return _priority.get()
+
+
+@contextmanager
+def request_priority(priority: int) -> Iterator[None]:
+    """Все запросы к апстриму внутри блока идут с этим приоритетом."""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    """Асинхронное ведро токенов с очередью по приоритету.
+
+    Ждущие обслуживаются строго по (приоритет, порядок прихода): фоновая
+    предзагрузка не обгонит пользователя, даже если пришла раньше.
+    """
+
+    def __init__(self, name: str, rate: float = RATE_LIMIT_RPS, burst: float = RATE_LIMIT_BURST) -> None:
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for _p, _s, f in self._waiters if not f.done())
+
+    def _report(self) -> None:
+        metrics.gauge(f"ratelimit.{self.name}.queue_depth", self.queue_depth)
+
+    def _drain(self) -> None:
+        self._wakeup = None
+        self._refill()
+        while self._waiters:
+            _p, _s, fut = self._waiters[0]
+            if fut.done():  # ожидание отменено или истекло
+                heapq.heappop(self._waiters)
+                continue
+            if self.tokens < 1:
+                break
+            heapq.heappop(self._waiters)
+            self.tokens -= 1
+            fut.set_result(None)
+        if self._waiters and self._wakeup is None:
+            delay = max(0.0, (1 - self.tokens) / self.rate)
+            self._wakeup = asyncio.get_running_loop().call_later(delay, self._drain)
+        self._report()
+
+    async def acquire(self, priority: Optional[int] = None, max_wait: float = RATE_LIMIT_MAX_WAIT) -> float:
+        """Дождаться токена; вернуть время ожидания в секундах."""
+        priority = current_priority() if priority is None else priority
+        budget = current_budget()
+        if budget is not None:
+            max_wait = min(max_wait, budget.remaining())
+        self._refill()
+        if not self._waiters and self.tokens >= 1:
+            self.tokens -= 1
+            metrics.observe(f"ratelimit.{self.name}.wait_ms", 0.0)
+            return 0.0
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        self._drain()
+        t0 = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), max_wait)
+        except asyncio.TimeoutError:
+            fut.cancel()
+            self._report()
+            metrics.inc(f"ratelimit.{self.name}.rejected")
+            raise RateLimited(f"{self.name}: queue wait exceeded {max_wait:.1f}s") from None
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.tokens += 1  # токен уже выдан, но не использован — вернуть
+            fut.cancel()
+            raise
+        waited = time.monotonic() - t0
+        metrics.observe(f"ratelimit.{self.name}.wait_ms", waited * 1000)
+        return waited
+
+
+_buckets: Dict[str, TokenBucket] = {}
+
+
+def bucket(name: str, rate: Optional[float] = None, burst: Optional[float] = None) -> TokenBucket:
+    """Общее ведро по имени (провайдер или провайдер:токен)."""
+    b = _buckets.get(name)
+    if b is None:
+        b = _buckets[name] = TokenBucket(
+            name,
+            rate=rate if rate is not None else RATE_LIMIT_RPS,
+            burst=burst if burst is not None else RATE_LIMIT_BURST,
+        )
+    return b
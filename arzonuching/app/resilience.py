@@ -0,0 +1,182 @@
+from __future__ import annotations
+import os
+import time
+import random
+import asyncio
+import logging
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from . import metrics
+from .budget import current_budget
+
+log = logging.getLogger("avia-bot.resilience")
+
+# =============================
+# ENV
+# =============================
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", "3"))               # всего попыток, включая первую
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.3"))       # сек
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "5"))           # дольше ждать Retry-After не будем
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))           # подряд неудачных вызовов (после всех повторов) до размыкания
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+
+T = TypeVar("T")
+
+
+class UpstreamError(Exception):
+    """Ошибка апстрима. retryable — имеет ли смысл повторить запрос;
+    upstream_fault=False — отказ не говорит о здоровье апстрима (квота
+    одного из ключей) и не размыкает предохранитель."""
+
+    def __init__(
+        self,
+        message: str,
+        status: int = 0,
+        retryable: bool = False,
+        retry_after: Optional[float] = None,
+        upstream_fault: bool = True,
+    ) -> None:
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+        self.retry_after = retry_after
+        self.upstream_fault = upstream_fault
+
+
+class CircuitOpen(UpstreamError):
+    pass
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After: число секунд или HTTP-дата."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, base: float = RETRY_BASE_DELAY, cap: float = RETRY_MAX_DELAY) -> float:
+    """Экспоненциальная задержка с full jitter: random(0, min(cap, base*2^attempt))."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """closed -> open после failure_threshold неудач подряд;
+    open -> half_open через reset_timeout; в half_open пропускается один
+    пробный вызов: успех замыкает цепь, неудача снова размыкает."""
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURES, reset_timeout: float = BREAKER_RESET_TIMEOUT) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        metrics.gauge(f"breaker.{name}.open", 0)
+
+    def _set(self, state: str) -> None:
+        if state == self.state:
+            return
+        log.warning("Breaker %s: %s -> %s", self.name, self.state, state)
+        metrics.inc(f"breaker.{self.name}.to_{state}")
+        metrics.gauge(f"breaker.{self.name}.open", 1 if state == "open" else 0)
+        self.state = state
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self._set("half_open")
+        # half_open: только один пробный вызов за раз
+        if self._trial_in_flight:
+            return False
+        self._trial_in_flight = True
+        return True
+
+    def release(self) -> None:
+        """Вызов не дал информации о здоровье апстрима (отмена, 4xx)."""
+        self._trial_in_flight = False
+
+    def on_success(self) -> None:
+        self._trial_in_flight = False
+        self.failures = 0
+        self._set("closed")
+
+    def on_failure(self) -> None:
+        self._trial_in_flight = False
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._set("open")
+
+
+async def call_with_retries(
+    name: str,
+    call: Callable[[], Awaitable[T]],
+    breaker: Optional[CircuitBreaker] = None,
+    attempts: int = RETRY_ATTEMPTS,
+) -> T:
+    """Выполнить идемпотентный вызов с повторами и предохранителем.
+
+    Повторяются только ошибки с retryable=True (5xx, 429, таймауты, сетевые).
+    Задержка — jittered exponential backoff, но не меньше Retry-After;
+    если ждать пришлось бы дольше RETRY_MAX_DELAY или дольше остатка
+    бюджета поиска, повтор не делается.
+    """
+    attempt = 0
+    while True:
+        if breaker is not None and not breaker.allow():
+            metrics.inc(f"breaker.{name}.rejected")
+            raise CircuitOpen(f"{name}: circuit open")
+        try:
+            result = await call()
+        except asyncio.CancelledError:
+            if breaker is not None:
+                breaker.release()
+            raise
+        except Exception as e:
+            retryable = getattr(e, "retryable", isinstance(e, (asyncio.TimeoutError, OSError)))
+            attempt += 1
+            delay = _retry_delay(e, attempt, attempts) if retryable else None
+            if delay is None:
+                if breaker is not None:
+                    # одна неудача на логический вызов, а не на попытку;
+                    # 4xx и квота ключа — не отказ апстрима: цепь не размыкаем
+                    if retryable and getattr(e, "upstream_fault", True):
+                        breaker.on_failure()
+                    else:
+                        breaker.release()
+                raise
+            if breaker is not None:
+                breaker.release()
+            metrics.inc(f"retry.{name}.attempts")
+            await asyncio.sleep(delay)
+            continue
+        if breaker is not None:
+            breaker.on_success()
+        return result
+
+
+def _retry_delay(e: Exception, attempt: int, attempts: int) -> Optional[float]:
+    """Пауза перед следующей попыткой; None — больше не пытаемся."""
+    if attempt >= attempts:
+        return None
+    delay = backoff_delay(attempt)
+    retry_after = getattr(e, "retry_after", None)
+    if retry_after is not None:
+        if retry_after > RETRY_MAX_DELAY:
+            return None
+        delay = max(delay, retry_after)
+    budget = current_budget()
+    if budget is not None and delay >= budget.remaining():
+        return None
+    return delay
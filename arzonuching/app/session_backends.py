@@ -0,0 +1,257 @@
+from __future__ import annotations
+import os
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlparse
+
+log = logging.getLogger("avia-bot.sessions")
+
+# =============================
+# ENV
+# =============================
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")   # memory (только процесс) | sqlite | redis
+SESSION_SQLITE_PATH = os.getenv("SESSION_SQLITE_PATH", "sessions.sqlite3")
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL", "redis://127.0.0.1:6379/0")
+
+
+class SessionBackend:
+    """Общий интерфейс: пачечное чтение/запись сериализованных сессий.
+
+    Ключ — (namespace, user_id), значение — bytes. ttl — сколько секунд
+    запись живёт без обновления.
+    """
+
+    async def load_many(self, ns: str, user_ids: Iterable[int]) -> Dict[int, bytes]:
+        raise NotImplementedError
+
+    async def save_many(self, ns: str, items: Dict[int, bytes], ttl: float) -> None:
+        raise NotImplementedError
+
+    async def delete_many(self, ns: str, user_ids: Iterable[int]) -> None:
+        raise NotImplementedError
+
+    async def cleanup(self) -> int:
+        return 0
+
+    async def close(self) -> None:
+        pass
+
+
+class SQLiteBackend(SessionBackend):
+    """Локальный SQLite-файл в режиме WAL, общий для воркеров одной машины."""
+
+    _SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS sessions ("
+        " ns TEXT NOT NULL, user_id INTEGER NOT NULL, data BLOB NOT NULL, expires_at REAL NOT NULL,"
+        " PRIMARY KEY (ns, user_id)) WITHOUT ROWID",
+        "CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires_at)",
+    )
+    _UPSERT = (
+        "INSERT INTO sessions (ns, user_id, data, expires_at) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT (ns, user_id) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at"
+    )
+
+    def __init__(self, path: str = SESSION_SQLITE_PATH) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        for stmt in self._SCHEMA:
+            self._db.execute(stmt)
+
+    def _load(self, ns: str, user_ids: List[int]) -> Dict[int, bytes]:
+        if not user_ids:
+            return {}
+        marks = ",".join("?" * len(user_ids))
+        sql = f"SELECT user_id, data FROM sessions WHERE ns = ? AND expires_at > ? AND user_id IN ({marks})"
+        with self._lock:
+            rows = self._db.execute(sql, (ns, time.time(), *user_ids)).fetchall()
+        return {uid: bytes(blob) for uid, blob in rows}
+
+    def _save(self, ns: str, items: Dict[int, bytes], ttl: float) -> None:
+        expires = time.time() + ttl
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(self._UPSERT, [(ns, uid, blob, expires) for uid, blob in items.items()])
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def _delete(self, ns: str, user_ids: List[int]) -> None:
+        with self._lock:
+            self._db.executemany("DELETE FROM sessions WHERE ns = ? AND user_id = ?", [(ns, uid) for uid in user_ids])
+
+    def _cleanup(self) -> int:
+        with self._lock:
+            return self._db.execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),)).rowcount
+
+    async def load_many(self, ns: str, user_ids: Iterable[int]) -> Dict[int, bytes]:
+        return await asyncio.to_thread(self._load, ns, list(user_ids))
+
+    async def save_many(self, ns: str, items: Dict[int, bytes], ttl: float) -> None:
+        if items:
+            await asyncio.to_thread(self._save, ns, dict(items), ttl)
+
+    async def delete_many(self, ns: str, user_ids: Iterable[int]) -> None:
+        ids = list(user_ids)
+        if ids:
+            await asyncio.to_thread(self._delete, ns, ids)
+
+    async def cleanup(self) -> int:
+        return await asyncio.to_thread(self._cleanup)
+
+    async def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+class RedisError(RuntimeError):
+    """Ответ сервера с ошибкой (-ERR ...); соединение при этом исправно."""
+
+
+class RedisBackend(SessionBackend):
+    """Минимальный клиент протокола RESP2 (GET/SET/DEL через pipeline).
+
+    Без внешних зависимостей; работает с Redis, KeyDB, Valkey или любым
+    локальным сервером, понимающим RESP.
+    """
+
+    def __init__(self, url: str = SESSION_REDIS_URL, prefix: str = "avia:sess") -> None:
+        u = urlparse(url)
+        self.host = u.hostname or "127.0.0.1"
+        self.port = u.port or 6379
+        self.password = u.password
+        self.db = int((u.path or "/0").lstrip("/") or 0)
+        self.prefix = prefix
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+
+    def _key(self, ns: str, uid: int) -> bytes:
+        return f"{self.prefix}:{ns}:{uid}".encode()
+
+    @staticmethod
+    def _encode(*parts: bytes) -> bytes:
+        out = [b"*%d\r\n" % len(parts)]
+        for p in parts:
+            out.append(b"$%d\r\n%s\r\n" % (len(p), p))
+        return b"".join(out)
+
+    async def _read_reply(self):
+        assert self._reader is not None
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("redis connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest
+        if kind == b"-":
+            # возвращаем, а не бросаем: ответы остальных команд пачки ещё в сокете
+            return RedisError(rest.decode(errors="replace"))
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            n = int(rest)
+            if n < 0:
+                return None
+            data = await self._reader.readexactly(n + 2)
+            return data[:-2]
+        if kind == b"*":
+            n = int(rest)
+            if n < 0:
+                return None
+            return [await self._read_reply() for _ in range(n)]
+        raise ConnectionError(f"unexpected RESP reply: {line!r}")
+
+    async def _connect(self) -> None:
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        hello: List[Tuple[bytes, ...]] = []
+        if self.password:
+            hello.append((b"AUTH", self.password.encode()))
+        if self.db:
+            hello.append((b"SELECT", str(self.db).encode()))
+        if hello:
+            await self._pipeline_raw(hello)
+
+    async def _pipeline_raw(self, commands: List[Tuple[bytes, ...]]) -> list:
+        assert self._writer is not None
+        self._writer.write(b"".join(self._encode(*c) for c in commands))
+        await self._writer.drain()
+        # сначала дочитываем все N ответов, иначе следующая пачка получит чужие
+        replies = [await self._read_reply() for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    def _drop(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def pipeline(self, commands: List[Tuple[bytes, ...]]) -> list:
+        """Отправить пачку команд одним write и прочитать ответы по порядку."""
+        async with self._lock:
+            for attempt in (1, 2):
+                try:
+                    if self._writer is None or self._writer.is_closing():
+                        await self._connect()
+                    return await self._pipeline_raw(commands)
+                except RedisError:
+                    raise
+                except (ConnectionError, OSError, asyncio.IncompleteReadError):
+                    self._drop()
+                    if attempt == 2:
+                        raise
+                except BaseException:
+                    # отмена или сбой посреди пачки: непрочитанные ответы
+                    # остались в сокете — соединение больше не годится
+                    self._drop()
+                    raise
+        return []
+
+    async def load_many(self, ns: str, user_ids: Iterable[int]) -> Dict[int, bytes]:
+        ids = list(user_ids)
+        if not ids:
+            return {}
+        (values,) = await self.pipeline([(b"MGET", *[self._key(ns, uid) for uid in ids])])
+        return {uid: v for uid, v in zip(ids, values or []) if v is not None}
+
+    async def save_many(self, ns: str, items: Dict[int, bytes], ttl: float) -> None:
+        if not items:
+            return
+        ex = str(max(1, int(ttl))).encode()
+        await self.pipeline([(b"SET", self._key(ns, uid), blob, b"EX", ex) for uid, blob in items.items()])
+
+    async def delete_many(self, ns: str, user_ids: Iterable[int]) -> None:
+        keys = [self._key(ns, uid) for uid in user_ids]
+        if keys:
+            await self.pipeline([(b"DEL", *keys)])
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except Exception:
+                pass
+            self._writer = None
+
+
+def backend_from_env() -> Optional[SessionBackend]:
+    """Бэкенд по SESSION_BACKEND; None — состояние живёт только в памяти процесса."""
+    kind = SESSION_BACKEND.lower()
+    if kind == "sqlite":
+        log.info("Session backend: sqlite (%s)", SESSION_SQLITE_PATH)
+        return SQLiteBackend(SESSION_SQLITE_PATH)
+    if kind == "redis":
+        log.info("Session backend: redis (%s)", SESSION_REDIS_URL)
+        return RedisBackend(SESSION_REDIS_URL)
+    return None
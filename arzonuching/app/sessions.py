@@ -0,0 +1,358 @@
+from __future__ import annotations
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Generic, Iterator, Optional, Set, Tuple, TypeVar
+
+from aiogram import BaseMiddleware
+
+from . import metrics
+from .session_backends import SessionBackend
+
+log = logging.getLogger("avia-bot.sessions")
+
+# =============================
+# ENV
+# =============================
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "10000"))
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", str(6 * 3600)))
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "60"))
+SESSION_SIZE_SAMPLE = int(os.getenv("SESSION_SIZE_SAMPLE", "200"))  # сессий в выборке для оценки памяти
+
+V = TypeVar("V")
+
+
+def approx_size(obj: Any, _seen: Optional[set] = None) -> int:
+    """Грубая оценка занимаемой памяти: sys.getsizeof по всему графу объекта."""
+    seen = _seen if _seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(approx_size(k, seen) + approx_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(approx_size(x, seen) for x in obj)
+    elif hasattr(obj, "__dict__"):
+        size += approx_size(vars(obj), seen)
+    elif hasattr(obj, "__slots__"):
+        size += sum(approx_size(getattr(obj, a), seen) for a in obj.__slots__ if hasattr(obj, a))
+    return size
+
+
+class SessionStore(Generic[V]):
+    """Хранилище состояний пользователей с лимитом записей и idle-TTL.
+
+    API совпадает с обычным dict (get/setdefault/[]/pop/in), поэтому
+    хендлеры не меняются. Сессия, к которой не обращались дольше
+    idle_ttl, считается отсутствующей; самые старые записи вытесняются
+    при превышении max_entries.
+
+    С подключённым бэкендом (use_backend) память процесса — только кэш:
+    перед обработкой апдейта сессия перечитывается из бэкенда, после —
+    записывается обратно, если изменилась (присвоение, удаление или
+    правка объекта на месте — сравниваем сериализованный вид). Чтения и
+    записи соседних апдейтов собираются в одну пачку (MGET / executemany).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_entries: int = SESSION_MAX_ENTRIES,
+        idle_ttl: float = SESSION_IDLE_TTL,
+    ) -> None:
+        self.name = name
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        # user_id -> (last_seen, state); порядок — от давно неактивных к свежим
+        self._data: "OrderedDict[int, Tuple[float, V]]" = OrderedDict()
+        self._sweeper: Optional[asyncio.Task] = None
+
+        self.backend: Optional[SessionBackend] = None
+        self._encode: Optional[Callable[[V], bytes]] = None
+        self._decode: Optional[Callable[[bytes], V]] = None
+        self._dirty: Set[int] = set()
+        self._deleted: Set[int] = set()
+        self._baseline: Dict[int, Optional[bytes]] = {}  # сериализованная сессия в начале апдейта
+        self._active: Dict[int, int] = {}
+        self._pending_loads: Set[int] = set()
+        self._load_batch: Optional[asyncio.Future] = None
+        self._pending_saves: Set[int] = set()
+        self._save_batch: Optional[asyncio.Future] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    def use_backend(
+        self,
+        backend: Optional[SessionBackend],
+        encode: Callable[[V], bytes],
+        decode: Callable[[bytes], V],
+    ) -> None:
+        self.backend = backend
+        self._encode = encode
+        self._decode = decode
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(list(self._data))
+
+    def __contains__(self, user_id: int) -> bool:
+        return self._live(user_id) is not None
+
+    def __getitem__(self, user_id: int) -> V:
+        v = self._live(user_id)
+        if v is None:
+            raise KeyError(user_id)
+        return v
+
+    def __setitem__(self, user_id: int, state: V) -> None:
+        self._data[user_id] = (time.time(), state)
+        self._data.move_to_end(user_id)
+        self._mark(user_id)
+        self._enforce_limit()
+
+    def __delitem__(self, user_id: int) -> None:
+        del self._data[user_id]
+        self._mark(user_id, deleted=True)
+
+    def get(self, user_id: int, default: Optional[V] = None) -> Optional[V]:
+        v = self._live(user_id)
+        return default if v is None else v
+
+    def setdefault(self, user_id: int, default: V) -> V:
+        v = self._live(user_id)
+        if v is None:
+            self[user_id] = default
+            return default
+        return v
+
+    def pop(self, user_id: int, default: Optional[V] = None) -> Optional[V]:
+        item = self._data.pop(user_id, None)
+        self._mark(user_id, deleted=True)
+        return default if item is None else item[1]
+
+    def _mark(self, user_id: int, deleted: bool = False) -> None:
+        if self.backend is None:
+            return
+        if deleted:
+            self._dirty.discard(user_id)
+            self._deleted.add(user_id)
+        else:
+            self._deleted.discard(user_id)
+            self._dirty.add(user_id)
+
+    def _live(self, user_id: int) -> Optional[V]:
+        item = self._data.get(user_id)
+        if item is None:
+            return None
+        now = time.time()
+        if now - item[0] > self.idle_ttl:
+            del self._data[user_id]
+            metrics.inc(f"sessions.{self.name}.expired")
+            return None
+        self._data[user_id] = (now, item[1])
+        self._data.move_to_end(user_id)
+        return item[1]
+
+    def _enforce_limit(self) -> None:
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            metrics.inc(f"sessions.{self.name}.evicted")
+
+    # ---------- бэкенд ----------
+    @asynccontextmanager
+    async def session(self, user_id: int) -> AsyncIterator[None]:
+        """Обёртка вокруг обработки одного апдейта пользователя."""
+        if self.backend is None:
+            yield
+            return
+        self._active[user_id] = self._active.get(user_id, 0) + 1
+        try:
+            # параллельный апдейт того же пользователя уже держит актуальный объект
+            if self._active[user_id] == 1:
+                await self.load(user_id)
+                self._baseline[user_id] = self._serialized(user_id)
+            yield
+        finally:
+            try:
+                if self._changed(user_id):
+                    await self.save(user_id)
+            finally:
+                self._active[user_id] -= 1
+                if not self._active[user_id]:
+                    del self._active[user_id]
+                    self._baseline.pop(user_id, None)
+
+    def _serialized(self, user_id: int) -> Optional[bytes]:
+        item = self._data.get(user_id)
+        return None if item is None else self._encode(item[1])
+
+    def _changed(self, user_id: int) -> bool:
+        """Изменилась ли сессия за апдейт; неизменённую не записываем."""
+        if user_id in self._deleted:
+            return True
+        blob = self._serialized(user_id)
+        if user_id in self._dirty or blob != self._baseline.get(user_id):
+            self._baseline[user_id] = blob
+            self._mark(user_id)
+            return True
+        return False
+
+    def _spawn(self, coro: Awaitable[None]) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def load(self, user_id: int) -> None:
+        self._pending_loads.add(user_id)
+        if self._load_batch is None:
+            self._load_batch = asyncio.get_running_loop().create_future()
+            self._spawn(self._run_load_batch(self._load_batch))
+        try:
+            await asyncio.shield(self._load_batch)
+        except Exception as e:
+            log.warning(f"Session load failed, using local copy: {e}")
+
+    async def _run_load_batch(self, fut: asyncio.Future) -> None:
+        # один тик цикла — чтобы соседние апдейты попали в ту же пачку
+        await asyncio.sleep(0)
+        ids, self._pending_loads = self._pending_loads, set()
+        self._load_batch = None
+        try:
+            t0 = time.perf_counter()
+            rows = await self.backend.load_many(self.name, ids)
+            metrics.observe(f"sessions.{self.name}.load_ms", (time.perf_counter() - t0) * 1000)
+            metrics.observe(f"sessions.{self.name}.load_batch", len(ids))
+            now = time.time()
+            for uid in ids:
+                blob = rows.get(uid)
+                if blob is not None:
+                    self._data[uid] = (now, self._decode(blob))
+                    self._data.move_to_end(uid)
+                else:
+                    self._data.pop(uid, None)
+            self._enforce_limit()
+            fut.set_result(None)
+        except Exception as e:
+            fut.set_exception(e)
+            fut.exception()
+
+    async def save(self, user_id: int) -> None:
+        self._pending_saves.add(user_id)
+        if self._save_batch is None:
+            self._save_batch = asyncio.get_running_loop().create_future()
+            self._spawn(self._run_save_batch(self._save_batch))
+        try:
+            await asyncio.shield(self._save_batch)
+        except Exception as e:
+            log.warning(f"Session save failed: {e}")
+
+    async def _run_save_batch(self, fut: asyncio.Future) -> None:
+        await asyncio.sleep(0)
+        ids, self._pending_saves = self._pending_saves, set()
+        self._save_batch = None
+        upserts: Dict[int, bytes] = {}
+        deletes = []
+        for uid in ids:
+            if uid in self._deleted:
+                self._deleted.discard(uid)
+                deletes.append(uid)
+                continue
+            self._dirty.discard(uid)
+            item = self._data.get(uid)
+            if item is not None:
+                upserts[uid] = self._encode(item[1])
+        try:
+            t0 = time.perf_counter()
+            if upserts:
+                await self.backend.save_many(self.name, upserts, self.idle_ttl)
+            if deletes:
+                await self.backend.delete_many(self.name, deletes)
+            metrics.observe(f"sessions.{self.name}.save_ms", (time.perf_counter() - t0) * 1000)
+            metrics.observe(f"sessions.{self.name}.save_batch", len(ids))
+            fut.set_result(None)
+        except Exception as e:
+            fut.set_exception(e)
+            fut.exception()
+
+    def sweep(self) -> int:
+        """Удалить все просроченные сессии; вернуть их число."""
+        deadline = time.time() - self.idle_ttl
+        removed = 0
+        # записи упорядочены по last_seen, поэтому достаточно идти с начала
+        while self._data:
+            user_id, (last_seen, _state) = next(iter(self._data.items()))
+            if last_seen > deadline:
+                break
+            del self._data[user_id]
+            removed += 1
+        if removed:
+            metrics.inc(f"sessions.{self.name}.expired", removed)
+        self.report()
+        return removed
+
+    def memory_bytes(self, sample: int = SESSION_SIZE_SAMPLE) -> int:
+        """Оценка памяти сессий по случайной выборке — обход всех на цикле событий дорог."""
+        states = [state for _ts, state in self._data.values()]
+        if len(states) > sample:
+            picked = random.sample(states, sample)
+            seen: set = set()
+            return int(sum(approx_size(state, seen) for state in picked) * len(states) / sample)
+        seen = set()
+        return sum(approx_size(state, seen) for state in states)
+
+    def report(self) -> Dict[str, float]:
+        stats = {"entries": len(self._data), "bytes": self.memory_bytes()}
+        metrics.gauge(f"sessions.{self.name}.entries", stats["entries"])
+        metrics.gauge(f"sessions.{self.name}.bytes", stats["bytes"])
+        return stats
+
+    async def _sweep_forever(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                removed = self.sweep()
+                if self.backend is not None:
+                    removed += await self.backend.cleanup()
+                if removed:
+                    log.info("Sessions %s: swept %s idle entries", self.name, removed)
+            except Exception as e:
+                log.warning(f"Session sweep failed: {e}")
+
+    def start_sweeper(self, interval: float = SESSION_SWEEP_INTERVAL) -> None:
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep_forever(interval))
+
+    async def stop_sweeper(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
+
+
+class SessionMiddleware(BaseMiddleware):
+    """Загружает сессию пользователя до хендлера и сохраняет после."""
+
+    def __init__(self, store: SessionStore) -> None:
+        self.store = store
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None or self.store.backend is None:
+            return await handler(event, data)
+        async with self.store.session(user.id):
+            return await handler(event, data)
@@ -0,0 +1,213 @@
+from __future__ import annotations
+import os
+import json
+import mmap
+import struct
+import hashlib
+import logging
+from typing import Any, Dict, Hashable, Iterator, Optional, Tuple
+
+from . import metrics
+from .l2cache import pack_value, unpack_value
+
+try:
+    import fcntl
+except ImportError:  # Windows — межпроцессный кэш недоступен
+    fcntl = None
+
+log = logging.getLogger("avia-bot.cache")
+
+# =============================
+# ENV
+# =============================
+SHM_CACHE_PATH = os.getenv("SHM_CACHE_PATH", "")                 # напр. /dev/shm/avia-prices; пусто — выключен
+SHM_CACHE_SLOTS = int(os.getenv("SHM_CACHE_SLOTS", "4096"))
+SHM_CACHE_SLOT_SIZE = int(os.getenv("SHM_CACHE_SLOT_SIZE", "4096"))  # байт на запись, включая заголовок
+SHM_CACHE_PROBES = 8       # длина цепочки открытой адресации
+SHM_READ_RETRIES = 4       # попыток чтения, если писатель успел переписать слот
+
+_MAGIC = b"AVSHM\x00\x02\x00"
+_HEADER = struct.Struct("<8sII")            # magic, число слотов, размер слота
+_HEADER_SIZE = 64
+# seq, хэш ключа (0 — слот пуст), expires_at, stored_at, длина ключа, длина значения
+_SLOT = struct.Struct("<QQddHI")
+_SLOT_HEADER = 40
+_SEQ = struct.Struct("<Q")
+
+Entry = Tuple[float, float, Any]  # (expires_at, stored_at, value)
+
+
+def _key_bytes(key: Hashable) -> bytes:
+    # JSON, а не encode_key: ключ должен восстанавливаться с типами (для снимка)
+    return json.dumps(list(key), separators=(",", ":")).encode()
+
+
+def _hash(k: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(k, digest_size=8).digest(), "little") or 1
+
+
+class ShmCache:
+    """Кэш цен в файле, отображённом в память всеми воркерами.
+
+    Файл — заголовок и SHM_CACHE_SLOTS слотов фиксированного размера.
+    Слот ищется открытой адресацией (линейное пробирование) по хэшу ключа;
+    записи не удаляются, а перезаписываются — поэтому пустой слот в
+    цепочке означает промах. Значение хранится упакованным
+    (pack_offers / int64-матрица) и разбирается прямо из отображения,
+    без промежуточной копии.
+
+    Читатели не берут блокировок: у слота есть счётчик seq (seqlock).
+    Писатель делает его нечётным, пишет, затем снова чётным; читатель
+    сверяет seq до и после разбора и при несовпадении повторяет чтение.
+    Писатели разных процессов сериализуются через flock на файле.
+    """
+
+    def __init__(self, path: str, slots: int = SHM_CACHE_SLOTS, slot_size: int = SHM_CACHE_SLOT_SIZE) -> None:
+        if fcntl is None:
+            raise RuntimeError("shared-memory cache needs fcntl (POSIX)")
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.payload = slot_size - _SLOT_HEADER
+        size = _HEADER_SIZE + slots * slot_size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            head = os.pread(self._fd, _HEADER.size, 0)
+            if os.fstat(self._fd).st_size != size or head != _HEADER.pack(_MAGIC, slots, slot_size):
+                # новый файл или другая геометрия — начинаем с чистого
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, _HEADER.pack(_MAGIC, slots, slot_size), 0)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._mm = mmap.mmap(self._fd, size)
+
+    def _offset(self, i: int) -> int:
+        return _HEADER_SIZE + i * self.slot_size
+
+    def _chain(self, h: int):
+        for p in range(SHM_CACHE_PROBES):
+            yield self._offset((h + p) % self.slots)
+
+    # ---------- чтение ----------
+    def _read(self, key: Hashable, with_value: bool) -> Optional[Entry]:
+        k = _key_bytes(key)
+        h = _hash(k)
+        mm = self._mm
+        with memoryview(mm) as mv:
+            for off in self._chain(h):
+                for _ in range(SHM_READ_RETRIES):
+                    seq, kh, expires_at, stored_at, klen, vlen = _SLOT.unpack_from(mm, off)
+                    if seq & 1:
+                        continue  # писатель в процессе
+                    if kh == 0:
+                        return None
+                    if kh != h or klen != len(k):
+                        break
+                    start = off + _SLOT_HEADER
+                    value = None
+                    try:
+                        if mv[start:start + klen] != k:
+                            break
+                        if with_value:
+                            value = unpack_value(mv[start + klen:start + klen + vlen])
+                    except Exception:
+                        value = None  # разорванное чтение — проверим seq
+                    if _SEQ.unpack_from(mm, off)[0] != seq:
+                        metrics.inc("cache.shm.retries")
+                        continue
+                    if with_value and value is None:
+                        return None
+                    return expires_at, stored_at, value
+                else:
+                    return None
+        return None
+
+    def get(self, key: Hashable) -> Optional[Entry]:
+        """(expires_at, stored_at, value) или None — без учёта свежести."""
+        entry = self._read(key, with_value=True)
+        metrics.inc("cache.shm.hit" if entry is not None else "cache.shm.miss")
+        return entry
+
+    def peek(self, key: Hashable) -> Optional[Tuple[float, float]]:
+        """(expires_at, stored_at) без разбора значения."""
+        entry = self._read(key, with_value=False)
+        return None if entry is None else (entry[0], entry[1])
+
+    # ---------- запись ----------
+    def put(self, key: Hashable, value: Any, expires_at: float, stored_at: float) -> bool:
+        """Записать значение; False — не поместилось или тип не поддерживается."""
+        blob = pack_value(value)
+        k = _key_bytes(key)
+        if blob is None or len(k) + len(blob) > self.payload:
+            metrics.inc("cache.shm.rejected")
+            return False
+        h = _hash(k)
+        mm = self._mm
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            target = victim = None
+            victim_exp = float("inf")
+            for off in self._chain(h):
+                _seq, kh, exp, _st, klen, _vlen = _SLOT.unpack_from(mm, off)
+                if kh == 0 or (kh == h and klen == len(k) and mm[off + _SLOT_HEADER:off + _SLOT_HEADER + klen] == k):
+                    target = off
+                    break
+                if exp < victim_exp:
+                    victim, victim_exp = off, exp
+            if target is None:
+                target = victim
+                metrics.inc("cache.shm.evicted")
+            seq = _SEQ.unpack_from(mm, target)[0]
+            _SEQ.pack_into(mm, target, seq + 1)  # нечётный: слот пишется
+            start = target + _SLOT_HEADER
+            mm[start:start + len(k)] = k
+            mm[start + len(k):start + len(k) + len(blob)] = blob
+            _SLOT.pack_into(mm, target, seq + 1, h, expires_at, stored_at, len(k), len(blob))
+            _SEQ.pack_into(mm, target, seq + 2)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return True
+
+    def items(self) -> Iterator[Tuple[Tuple, float, float, bytes]]:
+        """(key, expires_at, stored_at, упакованное значение) всех занятых слотов.
+
+        Без блокировок: слот, переписанный во время чтения, пропускается.
+        """
+        mm = self._mm
+        for i in range(self.slots):
+            off = self._offset(i)
+            seq, kh, expires_at, stored_at, klen, vlen = _SLOT.unpack_from(mm, off)
+            if kh == 0 or seq & 1:
+                continue
+            start = off + _SLOT_HEADER
+            k = mm[start:start + klen]
+            blob = mm[start + klen:start + klen + vlen]
+            if _SEQ.unpack_from(mm, off)[0] != seq:
+                continue
+            try:
+                key = tuple(json.loads(k))
+            except ValueError:
+                continue
+            yield key, expires_at, stored_at, blob
+
+    def stats(self) -> Dict[str, float]:
+        used = sum(1 for i in range(self.slots) if _SLOT.unpack_from(self._mm, self._offset(i))[1])
+        return {"slots": self.slots, "used": used, "bytes": _HEADER_SIZE + self.slots * self.slot_size}
+
+    def close(self) -> None:
+        self._mm.close()
+        os.close(self._fd)
+
+
+def shm_from_env() -> Optional[ShmCache]:
+    if not SHM_CACHE_PATH:
+        return None
+    try:
+        cache = ShmCache(SHM_CACHE_PATH)
+    except Exception as e:
+        log.warning(f"Shared-memory cache disabled: {e}")
+        return None
+    log.info("Price cache shared memory: %s (%s slots x %s bytes)", SHM_CACHE_PATH, SHM_CACHE_SLOTS, SHM_CACHE_SLOT_SIZE)
+    return cache
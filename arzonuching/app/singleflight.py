@@ -0,0 +1,55 @@
+from __future__ import annotations
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+from . import metrics
+
+
+class SingleFlight:
+    """Склейка одинаковых запросов, которые выполняются одновременно.
+
+    Первый вызывающий запускает загрузку, остальные с тем же ключом ждут
+    её результат (или ошибку). Отмена одного ожидающего не трогает общий
+    запрос; запрос отменяется, только если его больше никто не ждёт.
+    """
+
+    def __init__(self, name: str = "singleflight") -> None:
+        self.name = name
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self._waiters: Dict[Hashable, int] = {}
+        self.calls = 0
+        self.saved = 0
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        self.calls += 1
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            self._waiters[key] = 0
+            task.add_done_callback(lambda t, k=key: self._forget(k, t))
+        else:
+            self.saved += 1
+            metrics.inc(f"{self.name}.saved")
+
+        self._waiters[key] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done() and self._waiters.get(key) == 1:
+                task.cancel()
+            raise
+        finally:
+            if self._inflight.get(key) is task:
+                self._waiters[key] -= 1
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+            del self._waiters[key]
+        if not task.cancelled():
+            # ошибку уже получили ожидающие; здесь только гасим предупреждение
+            task.exception()
@@ -0,0 +1,159 @@
+from __future__ import annotations
+import os
+import json
+import time
+import struct
+import asyncio
+import logging
+from typing import Any, BinaryIO, Iterator, List, Optional, Tuple
+
+from . import metrics
+from .cache import CACHE_STALE_MAX_AGE, PriceCache, price_cache
+from .l2cache import pack_value, unpack_value
+from .prefetch import DemandTracker, demand
+from .shmcache import ShmCache
+
+log = logging.getLogger("avia-bot.snapshot")
+
+# =============================
+# ENV
+# =============================
+CACHE_SNAPSHOT_PATH = os.getenv("CACHE_SNAPSHOT_PATH", "")  # напр. price_cache.snap; пусто — без снимков
+CACHE_SNAPSHOT_INTERVAL = float(os.getenv("CACHE_SNAPSHOT_INTERVAL", "600"))  # сек между снимками
+
+# Файл: _MAGIC, затем записи подряд:
+#   тип (B), длина ключа (H), длина данных (I), ключ (JSON-массив), данные.
+#   _PRICE: expires_at, stored_at (dd) + упакованное значение;
+#   _DEMAND: счётчик, ts (dd).
+_MAGIC = b"AVSNAP\x01\n"
+_RECORD = struct.Struct("<BHI")
+_TIMES = struct.Struct("<dd")
+_PRICE = 1
+_DEMAND = 2
+_YIELD_EVERY = 200  # записей между уступками циклу событий при загрузке
+
+Record = Tuple[int, Tuple, Tuple]
+
+
+def _key(key: Any) -> bytes:
+    return json.dumps(list(key), separators=(",", ":")).encode()
+
+
+def _records(cache: PriceCache, tracker: DemandTracker) -> List[Record]:
+    """Собрать записи снимка; вызывается в потоке событий, копирует только ссылки."""
+    out: List[Record] = []
+    for key, expires_at, stored_at, value in cache.items():
+        out.append((_PRICE, key, (expires_at, stored_at, value)))
+    for key, score, ts in tracker.items():
+        out.append((_DEMAND, key, (score, ts)))
+    return out
+
+
+def _write(path: str, records: List[Record], shared: Optional[ShmCache] = None) -> int:
+    tmp = f"{path}.{os.getpid()}.tmp"  # воркеры пишут каждый в свой временный файл
+    if shared is not None:
+        # с общей памятью почти весь кэш — там; значения уже упакованы
+        records = [(_PRICE, key, (exp, stored, blob)) for key, exp, stored, blob in shared.items()] + records
+    written = 0
+    with open(tmp, "wb") as f:
+        f.write(_MAGIC)
+        for kind, key, data in records:
+            if kind == _PRICE:
+                expires_at, stored_at, value = data
+                blob = value if isinstance(value, bytes) else pack_value(value)
+                if blob is None:
+                    continue
+                payload = _TIMES.pack(expires_at, stored_at) + blob
+            else:
+                payload = _TIMES.pack(*data)
+            k = _key(key)
+            f.write(_RECORD.pack(kind, len(k), len(payload)))
+            f.write(k)
+            f.write(payload)
+            written += 1
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return written
+
+
+async def save_snapshot(
+    path: str = CACHE_SNAPSHOT_PATH, cache: PriceCache = price_cache, tracker: DemandTracker = demand
+) -> int:
+    """Записать снимок кэша цен (процесса и общей памяти) и счётчиков спроса; вернуть число записей."""
+    if not path:
+        return 0
+    t0 = time.perf_counter()
+    records = _records(cache, tracker)
+    # упаковка и запись — в потоке, чтобы не задерживать апдейты
+    written = await asyncio.to_thread(_write, path, records, cache.shared)
+    metrics.observe("snapshot.save_ms", (time.perf_counter() - t0) * 1000)
+    metrics.gauge("snapshot.records", written)
+    log.info("Cache snapshot saved: %s records -> %s", written, path)
+    return written
+
+
+def _read_records(f: BinaryIO) -> Iterator[Tuple[int, bytes, bytes]]:
+    if f.read(len(_MAGIC)) != _MAGIC:
+        raise ValueError("not a cache snapshot")
+    while True:
+        head = f.read(_RECORD.size)
+        if not head:
+            return
+        if len(head) < _RECORD.size:
+            raise ValueError("truncated snapshot")
+        kind, klen, plen = _RECORD.unpack(head)
+        key = f.read(klen)
+        payload = f.read(plen)
+        if len(key) < klen or len(payload) < plen:
+            raise ValueError("truncated snapshot")
+        yield kind, key, payload
+
+
+async def load_snapshot(
+    path: str = CACHE_SNAPSHOT_PATH, cache: PriceCache = price_cache, tracker: DemandTracker = demand
+) -> int:
+    """Потоково прочитать снимок и наполнить кэш; вернуть число загруженных записей.
+
+    Сроки записей — исходные: протухшее за время простоя попадает в кэш
+    только как запасной ответ, а старше CACHE_STALE_MAX_AGE — пропускается.
+    """
+    if not path or not os.path.exists(path):
+        return 0
+    t0 = time.perf_counter()
+    now = time.time()
+    loaded = skipped = 0
+    try:
+        with open(path, "rb") as f:
+            for i, (kind, raw_key, payload) in enumerate(_read_records(f)):
+                if i and i % _YIELD_EVERY == 0:
+                    await asyncio.sleep(0)
+                key = tuple(json.loads(raw_key))
+                a, b = _TIMES.unpack_from(payload)
+                if kind == _PRICE:
+                    expires_at, stored_at = a, b
+                    if now - stored_at > CACHE_STALE_MAX_AGE:
+                        skipped += 1
+                        continue
+                    cache.put(key, unpack_value(payload[_TIMES.size:]), expires_at, stored_at)
+                elif kind == _DEMAND:
+                    tracker.restore(key, a, b)
+                else:
+                    continue
+                loaded += 1
+    except Exception as e:
+        # битый хвост — оставляем то, что успели прочитать
+        log.warning(f"Cache snapshot {path} partially loaded: {e}")
+    metrics.observe("snapshot.load_ms", (time.perf_counter() - t0) * 1000)
+    log.info("Cache snapshot loaded: %s records (%s expired) from %s", loaded, skipped, path)
+    return loaded
+
+
+async def run_snapshots(interval: float = CACHE_SNAPSHOT_INTERVAL) -> None:
+    """Периодические снимки — на случай, если процесс убьют без штатной остановки."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await save_snapshot()
+        except Exception as e:
+            log.warning(f"Cache snapshot failed: {e}")
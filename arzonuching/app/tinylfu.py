@@ -0,0 +1,88 @@
+from __future__ import annotations
+import os
+from typing import Hashable, Optional
+
+from . import metrics
+
+# =============================
+# ENV
+# =============================
+CACHE_ADMISSION = os.getenv("CACHE_ADMISSION", "lru").lower()      # lru | tinylfu
+CACHE_WINDOW_PCT = float(os.getenv("CACHE_WINDOW_PCT", "1"))       # доля окна W-TinyLFU, % от ёмкости
+CACHE_SKETCH_SAMPLE = int(os.getenv("CACHE_SKETCH_SAMPLE", "10"))  # «старение» после sample × ёмкость обращений
+
+_MASK64 = (1 << 64) - 1
+_SEEDS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0x27D4EB2F165667C5)
+_MAX_COUNT = 15  # как у 4-битных счётчиков
+_HALF = bytes(i >> 1 for i in range(256))
+
+
+def _pow2(n: int) -> int:
+    p = 1
+    while p < n:
+        p <<= 1
+    return p
+
+
+class TinyLFU:
+    """Оценка частоты обращений к ключам: count-min sketch + doorkeeper.
+
+    Первое обращение к ключу отмечается только в doorkeeper (фильтр Блума),
+    счётчики sketch растут со второго — разовые ключи не засоряют sketch.
+    После sample обращений все счётчики делятся пополам, а doorkeeper
+    очищается: частоты отражают недавнее прошлое.
+    """
+
+    def __init__(self, capacity: int, sample_factor: int = CACHE_SKETCH_SAMPLE) -> None:
+        self.width = _pow2(max(16, capacity))
+        self.mask = self.width - 1
+        self.rows = [bytearray(self.width) for _ in _SEEDS]
+        self.door_bits = self.width * 8
+        self.door = bytearray(self.door_bits // 8)
+        self.sample = max(1, capacity * sample_factor)
+        self.additions = 0
+
+    def _indexes(self, key: Hashable):
+        h = hash(key) & _MASK64
+        for seed in _SEEDS:
+            x = ((h ^ seed) * 0xFF51AFD7ED558CCD) & _MASK64
+            yield (x >> 29) & self.mask
+
+    def _door_positions(self, key: Hashable):
+        h = hash(key) & _MASK64
+        return (h % self.door_bits, ((h >> 32) * 0x9E3779B1) % self.door_bits)
+
+    def _in_door(self, key: Hashable) -> bool:
+        return all(self.door[p >> 3] & (1 << (p & 7)) for p in self._door_positions(key))
+
+    def record(self, key: Hashable) -> None:
+        self.additions += 1
+        if not self._in_door(key):
+            for p in self._door_positions(key):
+                self.door[p >> 3] |= 1 << (p & 7)
+        else:
+            for row, i in zip(self.rows, self._indexes(key)):
+                if row[i] < _MAX_COUNT:
+                    row[i] += 1
+        if self.additions >= self.sample:
+            self._age()
+
+    def estimate(self, key: Hashable) -> int:
+        freq = min(row[i] for row, i in zip(self.rows, self._indexes(key)))
+        return freq + (1 if self._in_door(key) else 0)
+
+    def admit(self, candidate: Hashable, victim: Hashable) -> bool:
+        """Пускать кандидата в основную область вместо жертвы?"""
+        ok = self.estimate(candidate) > self.estimate(victim)
+        metrics.inc("cache.admission.admitted" if ok else "cache.admission.rejected")
+        return ok
+
+    def _age(self) -> None:
+        self.rows = [bytearray(row.translate(_HALF)) for row in self.rows]
+        self.door = bytearray(len(self.door))
+        self.additions //= 2
+        metrics.inc("cache.admission.resets")
+
+
+def admission_from_env(capacity: int) -> Optional[TinyLFU]:
+    return TinyLFU(capacity) if CACHE_ADMISSION == "tinylfu" else None
@@ -0,0 +1,151 @@
+from __future__ import annotations
+import os
+import time
+import logging
+from typing import Dict, List, Mapping, Optional
+
+from . import metrics
+from .ratelimit import RATE_LIMIT_BURST, RATE_LIMIT_RPS, TokenBucket, bucket
+from .resilience import UpstreamError, parse_retry_after
+
+log = logging.getLogger("avia-bot.tokens")
+
+# =============================
+# ENV
+# =============================
+TOKEN_QUOTA = int(os.getenv("TP_TOKEN_QUOTA", "600"))               # запросов на токен за окно
+TOKEN_QUOTA_WINDOW = float(os.getenv("TP_TOKEN_QUOTA_WINDOW", "60"))  # сек
+TOKEN_COOLDOWN = float(os.getenv("TP_TOKEN_COOLDOWN", "60"))        # пауза после 429/403 без Retry-After
+
+
+def tokens_from_env() -> List[str]:
+    """TP_TOKENS (через запятую) плюс старые одиночные переменные, без повторов."""
+    raw = [t.strip() for t in os.getenv("TP_TOKENS", "").split(",")]
+    raw += [os.getenv("TP_API_TOKEN", ""), os.getenv("TRAVELPAYOUTS_TOKEN", ""), os.getenv("TP_TOKEN", "")]
+    out: List[str] = []
+    for t in raw:
+        t = t.strip()
+        if t and t not in out:
+            out.append(t)
+    return out
+
+
+TP_TOKENS = tokens_from_env()
+
+
+class NoTokenAvailable(UpstreamError):
+    """Все токены на паузе; в апстрим не ходили."""
+
+
+class ApiToken:
+    """Один ключ API: своё ведро лимитера, остаток квоты, пауза после 429/403."""
+
+    def __init__(self, pool: str, index: int, value: str, rate: float, burst: float) -> None:
+        self.value = value
+        # в логи и метрики — номер в пуле и хвост ключа; номер делает имя уникальным
+        self.label = f"#{index}…{value[-4:]}" if len(value) > 4 else f"#{index}"
+        self.name = f"{pool}.{self.label}"
+        self.limiter: TokenBucket = bucket(f"{pool}:{self.label}", rate, burst)
+        self.calls = 0
+        self.errors = 0
+        self.rejected = 0
+        self.cooldown_until = 0.0
+        self.window_start = time.monotonic()
+        self.used = 0
+        self.reported_remaining: Optional[int] = None
+
+    def cooling(self, now: float) -> bool:
+        return now < self.cooldown_until
+
+    def remaining(self, now: float) -> int:
+        if now - self.window_start >= TOKEN_QUOTA_WINDOW:
+            self.window_start = now
+            self.used = 0
+            self.reported_remaining = None
+        left = TOKEN_QUOTA - self.used
+        if self.reported_remaining is not None:
+            left = min(left, self.reported_remaining)
+        return max(0, left)
+
+    def summary(self, now: float) -> str:
+        state = f"пауза {self.cooldown_until - now:.0f} с" if self.cooling(now) else "в ротации"
+        return (
+            f"  {self.label}: {self.calls} запросов, ошибок {self.errors}, 429/403 — {self.rejected}, "
+            f"остаток {self.remaining(now)}, {state}"
+        )
+
+
+class TokenPool:
+    """Ротация нескольких ключей одного провайдера.
+
+    Запрос получает ключ с наибольшим остатком квоты в текущем окне;
+    ключ, получивший 429/403, выводится из ротации на Retry-After
+    (или TP_TOKEN_COOLDOWN). У каждого ключа своё ведро лимитера, так что
+    пропускная способность растёт с числом ключей.
+    """
+
+    def __init__(
+        self, name: str, values: List[str], rate: float = RATE_LIMIT_RPS, burst: float = RATE_LIMIT_BURST
+    ) -> None:
+        self.name = name
+        self.tokens = [ApiToken(name, i, v, rate, burst) for i, v in enumerate(values)]
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    def available(self) -> bool:
+        now = time.monotonic()
+        return any(not t.cooling(now) for t in self.tokens)
+
+    def pick(self) -> ApiToken:
+        now = time.monotonic()
+        ready = [t for t in self.tokens if not t.cooling(now)]
+        if not ready:
+            wait = min((t.cooldown_until - now for t in self.tokens), default=TOKEN_COOLDOWN)
+            metrics.inc(f"tokens.{self.name}.exhausted")
+            raise NoTokenAvailable(f"{self.name}: all tokens cooling down", retry_after=wait)
+        # при равном остатке — тот, у кого короче очередь лимитера
+        return max(ready, key=lambda t: (t.remaining(now), -t.limiter.queue_depth))
+
+    async def acquire(self) -> ApiToken:
+        """Выбрать ключ и дождаться места в его ведре."""
+        token = self.pick()
+        await token.limiter.acquire()
+        # квоту расходует только ушедший запрос, а не отказ лимитера
+        token.used += 1
+        token.calls += 1
+        metrics.inc(f"tokens.{token.name}.calls")
+        return token
+
+    def on_response(self, token: ApiToken, status: int, headers: Optional[Mapping[str, str]] = None) -> None:
+        headers = headers or {}
+        left = headers.get("X-RateLimit-Remaining")
+        if left is not None and str(left).isdigit():
+            token.reported_remaining = int(left)
+        if status in (403, 429):
+            pause = parse_retry_after(headers.get("Retry-After")) or TOKEN_COOLDOWN
+            token.cooldown_until = time.monotonic() + pause
+            token.rejected += 1
+            metrics.inc(f"tokens.{token.name}.cooldowns")
+            log.warning("Token %s of %s: HTTP %s, out of rotation for %.0fs", token.label, self.name, status, pause)
+        elif status != 200:
+            token.errors += 1
+            metrics.inc(f"tokens.{token.name}.errors")
+        metrics.gauge(f"tokens.{token.name}.remaining", token.remaining(time.monotonic()))
+
+    def usage(self) -> Dict[str, Dict[str, float]]:
+        now = time.monotonic()
+        return {
+            t.label: {
+                "calls": t.calls,
+                "errors": t.errors,
+                "rejected": t.rejected,
+                "remaining": t.remaining(now),
+                "cooling": max(0.0, t.cooldown_until - now),
+            }
+            for t in self.tokens
+        }
+
+    def summary(self) -> str:
+        now = time.monotonic()
+        return "\n".join(t.summary(now) for t in self.tokens)
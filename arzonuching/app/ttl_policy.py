@@ -0,0 +1,142 @@
+from __future__ import annotations
+import os
+import math
+from datetime import date
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from . import metrics
+
+# =============================
+# ENV
+# =============================
+# "до N дней:множитель" через запятую; последняя граница — inf
+CACHE_TTL_BUCKETS = os.getenv("CACHE_TTL_BUCKETS", "1:0.25,7:0.5,30:1,90:3,inf:6")
+CACHE_TTL_MIN = float(os.getenv("CACHE_TTL_MIN", "60"))
+CACHE_TTL_MAX = float(os.getenv("CACHE_TTL_MAX", str(6 * 3600)))
+CACHE_TTL_POPULARITY_WEIGHT = float(os.getenv("CACHE_TTL_POPULARITY_WEIGHT", "0.15"))
+CACHE_TTL_VOLATILITY_WEIGHT = float(os.getenv("CACHE_TTL_VOLATILITY_WEIGHT", "5"))
+VOLATILITY_ALPHA = 0.3  # вес нового замера в EWMA изменения цены
+
+
+def parse_buckets(spec: str) -> List[Tuple[float, float, str]]:
+    """"1:0.25,7:0.5,inf:6" -> [(1, 0.25, "d0-1"), (7, 0.5, "d2-7"), (inf, 6, "d8+")]."""
+    out: List[Tuple[float, float, str]] = []
+    lo = 0
+    for part in spec.split(","):
+        bound, _, factor = part.strip().partition(":")
+        upper = math.inf if bound.strip() == "inf" else float(bound)
+        name = f"d{lo}+" if upper == math.inf else f"d{lo}-{int(upper)}"
+        out.append((upper, float(factor), name))
+        lo = int(upper) + 1 if upper != math.inf else lo
+    return out
+
+
+def _min_price(value: Any) -> Optional[int]:
+    """Минимальная цена в значении кэша: список Offer или месячная матрица."""
+    prices = []
+    for item in value or ():
+        p = getattr(item, "price", item)
+        if isinstance(p, (int, float)) and p > 0:
+            prices.append(p)
+    return min(prices) if prices else None
+
+
+class TtlPolicy:
+    """TTL записи = базовый TTL провайдера × множители.
+
+    - до вылета: ближние даты живут меньше (таблица CACHE_TTL_BUCKETS);
+    - популярность маршрута: чем чаще спрашивают, тем свежее держим —
+      цена запроса делится на всех, кто попадёт в кэш;
+    - волатильность: если цена маршрута между обновлениями заметно
+      прыгает, TTL сокращается.
+    Итог ограничен CACHE_TTL_MIN..CACHE_TTL_MAX. Попадания и промахи
+    считаются по корзинам «дней до вылета».
+    """
+
+    def __init__(self, buckets: str = CACHE_TTL_BUCKETS) -> None:
+        self.buckets = parse_buckets(buckets)
+        # (origin, destination) -> популярность; подставляет модуль предзагрузки
+        self.popularity: Callable[[str, str], float] = lambda origin, destination: 0.0
+        self._volatility: Dict[Tuple[str, str], float] = {}
+        self._hits: Dict[str, int] = {}
+        self._misses: Dict[str, int] = {}
+
+    @staticmethod
+    def _route(key: Tuple) -> Optional[Tuple[str, str]]:
+        if len(key) >= 4 and isinstance(key[1], str) and isinstance(key[2], str):
+            return key[1], key[2]
+        return None
+
+    @staticmethod
+    def days_ahead(key: Tuple, today: Optional[date] = None) -> Optional[int]:
+        """Дней до вылета по ключу price_key; у месячных ключей — до начала месяца."""
+        if len(key) < 4 or not isinstance(key[3], str):
+            return None
+        today = today or date.today()
+        raw = key[3]
+        try:
+            d = date.fromisoformat(raw if len(raw) == 10 else f"{raw[:7]}-01")
+        except ValueError:
+            return None
+        return max(0, (max(d, today) - today).days)
+
+    def bucket(self, key: Hashable) -> Tuple[float, str]:
+        days = self.days_ahead(key) if isinstance(key, tuple) else None
+        if days is None:
+            return 1.0, "other"
+        for upper, factor, name in self.buckets:
+            if days <= upper:
+                return factor, name
+        return 1.0, "other"
+
+    def ttl(self, key: Hashable, base: float, empty: bool = False) -> float:
+        factor, _name = self.bucket(key)
+        route = self._route(key) if isinstance(key, tuple) else None
+        if route is not None and not empty:
+            pop = max(0.0, self.popularity(*route))
+            factor /= 1 + CACHE_TTL_POPULARITY_WEIGHT * math.log1p(pop)
+            factor /= 1 + CACHE_TTL_VOLATILITY_WEIGHT * self._volatility.get(route, 0.0)
+        ttl = base * factor
+        # пустой ответ короткий и так — не поднимаем его до CACHE_TTL_MIN
+        return min(CACHE_TTL_MAX, ttl if empty else max(CACHE_TTL_MIN, ttl))
+
+    def observe(self, key: Hashable, old: Any, new: Any) -> None:
+        """Учесть, насколько изменилась минимальная цена при обновлении записи."""
+        route = self._route(key) if isinstance(key, tuple) else None
+        a, b = _min_price(old), _min_price(new)
+        if route is None or a is None or b is None:
+            return
+        change = abs(b - a) / a
+        prev = self._volatility.get(route)
+        self._volatility[route] = change if prev is None else prev + VOLATILITY_ALPHA * (change - prev)
+        metrics.observe("cache.price_change", change)
+
+    def volatility(self, origin: str, destination: str) -> float:
+        return self._volatility.get((origin.upper(), destination.upper()), 0.0)
+
+    def record(self, key: Hashable, hit: bool) -> None:
+        _factor, name = self.bucket(key)
+        if hit:
+            self._hits[name] = self._hits.get(name, 0) + 1
+            metrics.inc(f"cache.{name}.hit")
+        else:
+            self._misses[name] = self._misses.get(name, 0) + 1
+            metrics.inc(f"cache.{name}.miss")
+
+    def hit_ratios(self) -> Dict[str, float]:
+        out = {}
+        for name in [b[2] for b in self.buckets] + ["other"]:
+            if name not in self._hits and name not in self._misses:
+                continue
+            h, m = self._hits.get(name, 0), self._misses.get(name, 0)
+            out[name] = h / (h + m) if h + m else 0.0
+        return out
+
+    def summary(self) -> str:
+        ratios = self.hit_ratios()
+        if not ratios:
+            return ""
+        return "Hit ratio по дням до вылета: " + ", ".join(f"{k} {v:.0%}" for k, v in ratios.items())
+
+
+ttl_policy = TtlPolicy()
@@ -0,0 +1,62 @@
+"""/avia не блокирует цикл событий: параллельные запросы к апстриму перекрываются."""
+import os
+import time
+import asyncio
+from datetime import date, timedelta
+
+os.environ.setdefault("TP_TOKENS", "test-token-0001")
+
+import aiohttp
+from aiohttp import web
+
+from app.aviasales import tp_search_prices_for_date
+from app.providers import get_provider
+
+N = 8
+DELAY = 0.3
+
+
+def test_concurrent_searches_overlap(monkeypatch):
+    in_flight = 0
+    peak = 0
+
+    async def prices(request: web.Request) -> web.Response:
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(DELAY)
+        in_flight -= 1
+        item = {
+            "price": 100, "airline": "HY", "flight_number": "101",
+            "departure_at": f"{request.query['departure_at']}T10:00:00+05:00",
+            "origin": "TAS", "destination": "IST", "transfers": 0, "link": "/x",
+        }
+        return web.json_response({"success": True, "data": [item]})
+
+    async def body():
+        app = web.Application()
+        app.router.add_get("/prices", prices)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        monkeypatch.setattr(get_provider("travelpayouts"), "URL", f"http://127.0.0.1:{port}/prices")
+        first = date.today() + timedelta(days=30)
+        try:
+            async with aiohttp.ClientSession() as session:
+                t0 = time.perf_counter()
+                results = await asyncio.gather(*(
+                    tp_search_prices_for_date("TAS", "IST", (first + timedelta(days=i)).isoformat(), session)
+                    for i in range(N)
+                ))
+                elapsed = time.perf_counter() - t0
+        finally:
+            await runner.cleanup()
+        return results, elapsed
+
+    results, elapsed = asyncio.run(body())
+    assert all(len(r) == 1 and r[0].price == 100 for r in results)
+    assert peak > 1
+    # последовательно вышло бы N * DELAY
+    assert elapsed < N * DELAY / 2
@@ -0,0 +1,73 @@
+"""progressive_merge под бюджетом поиска: протухший кэш успевает вернуться."""
+import os
+import time
+import asyncio
+
+os.environ.setdefault("TP_TOKENS", "test-token-0001")
+
+from app.budget import search_budget
+from app.cache import cached_fetch, price_cache
+from app.offers import Offer
+from app.progressive import progressive_merge
+
+
+def test_stale_fallback_survives_budget_deadline():
+    key = ("test", "TAS", "IST", "2030-01-15", "usd")
+    offer = Offer(100, "HY", "101", None, "TAS", "IST", 0, "/x")
+    now = time.time()
+    price_cache.put(key, [offer], expires_at=now - 1, stored_at=now - 300)
+
+    async def hang():
+        await asyncio.sleep(60)
+        return []
+
+    async def noop(offers):
+        pass
+
+    async def body():
+        with search_budget(0.3) as budget:
+            result = await progressive_merge(
+                [cached_fetch("test", key, hang)], on_partial=noop, budget=budget.remaining()
+            )
+        return result, budget.stale_note()
+
+    try:
+        result, note = asyncio.run(body())
+    finally:
+        price_cache.clear()
+    assert [o.price for o in result] == [100]
+    assert "5 мин" in note
+
+
+class FlakyMessage:
+    def __init__(self):
+        self.edits = []
+
+    async def edit_text(self, text, reply_markup=None, disable_web_page_preview=None):
+        if not self.edits and "partial" in text:
+            self.edits.append(None)
+            raise RuntimeError("Flood control exceeded")
+        self.edits.append(text)
+
+
+def test_failed_partial_edit_does_not_abort_merge():
+    from app.progressive import MessageUpdater
+
+    async def source(price, delay):
+        await asyncio.sleep(delay)
+        return [Offer(price, "HY", str(price), price, "TAS", "IST", 0, "/x")]
+
+    async def body():
+        msg = FlakyMessage()
+        updater = MessageUpdater(msg, min_interval=0)
+
+        async def on_partial(offers):
+            await updater.update("partial")
+
+        result = await progressive_merge([source(200, 0.01), source(100, 0.05)], on_partial=on_partial)
+        await updater.update("final", final=True)
+        return result, msg.edits
+
+    result, edits = asyncio.run(body())
+    assert [o.price for o in result] == [100, 200]
+    assert edits[-1] == "final"
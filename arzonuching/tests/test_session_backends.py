@@ -0,0 +1,118 @@
+"""RedisBackend против локального RESP-сервера на asyncio (без настоящего Redis)."""
+import time
+import asyncio
+
+import pytest
+
+from app.session_backends import RedisBackend, RedisError
+
+
+class RespStub:
+    """Мини-сервер RESP2: MGET, SET ... EX, DEL; SLOW отвечает с задержкой, прочее — -ERR."""
+
+    def __init__(self) -> None:
+        self.data = {}
+        self.server = None
+
+    async def start(self) -> str:
+        self.server = await asyncio.start_server(self._client, "127.0.0.1", 0)
+        port = self.server.sockets[0].getsockname()[1]
+        return f"redis://127.0.0.1:{port}/0"
+
+    async def stop(self) -> None:
+        self.server.close()
+        await self.server.wait_closed()
+
+    @staticmethod
+    async def _command(reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        assert line[:1] == b"*"
+        parts = []
+        for _ in range(int(line[1:-2])):
+            n = int((await reader.readline())[1:-2])
+            parts.append((await reader.readexactly(n + 2))[:-2])
+        return parts
+
+    @staticmethod
+    def _bulk(v):
+        return b"$-1\r\n" if v is None else b"$%d\r\n%s\r\n" % (len(v), v)
+
+    async def _client(self, reader, writer):
+        while True:
+            cmd = await self._command(reader)
+            if cmd is None:
+                break
+            name, args = cmd[0].upper(), cmd[1:]
+            now = time.time()
+            if name == b"MGET":
+                vals = []
+                for k in args:
+                    item = self.data.get(k)
+                    vals.append(item[1] if item and item[0] > now else None)
+                reply = b"*%d\r\n" % len(vals) + b"".join(self._bulk(v) for v in vals)
+            elif name == b"SET":
+                assert args[2].upper() == b"EX"
+                self.data[args[0]] = (now + int(args[3]), args[1])
+                reply = b"+OK\r\n"
+            elif name == b"DEL":
+                n = sum(1 for k in args if self.data.pop(k, None) is not None)
+                reply = b":%d\r\n" % n
+            elif name == b"SLOW":
+                await asyncio.sleep(0.5)
+                reply = b"+OK\r\n"
+            else:
+                reply = b"-ERR unknown command '%s'\r\n" % name
+            writer.write(reply)
+            await writer.drain()
+        writer.close()
+
+
+def run(coro_fn):
+    async def wrapper():
+        stub = RespStub()
+        backend = RedisBackend(await stub.start())
+        try:
+            await coro_fn(stub, backend)
+        finally:
+            await backend.close()
+            await stub.stop()
+    asyncio.run(wrapper())
+
+
+def test_save_load_delete():
+    async def body(stub, backend):
+        await backend.save_many("s", {1: b"one", 2: b"two"}, ttl=60)
+        assert await backend.load_many("s", [1, 2, 3]) == {1: b"one", 2: b"two"}
+        await backend.delete_many("s", [1])
+        assert await backend.load_many("s", [1, 2]) == {2: b"two"}
+        assert await backend.load_many("other", [2]) == {}
+    run(body)
+
+
+def test_error_reply_mid_pipeline_keeps_connection_in_sync():
+    async def body(stub, backend):
+        with pytest.raises(RedisError):
+            await backend.pipeline([
+                (b"SET", b"a", b"1", b"EX", b"60"),
+                (b"BOGUS",),
+                (b"SET", b"b", b"2", b"EX", b"60"),
+            ])
+        # все три ответа прочитаны: следующий запрос получает свой ответ
+        assert await backend.pipeline([(b"MGET", b"a", b"b")]) == [[b"1", b"2"]]
+    run(body)
+
+
+def test_cancel_mid_pipeline_drops_connection():
+    async def body(stub, backend):
+        await backend.save_many("s", {7: b"mine"}, ttl=60)
+        task = asyncio.create_task(backend.pipeline([(b"SLOW",), (b"MGET", backend._key("s", 7))]))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0.6)  # опоздавшие ответы уходят в закрытый сокет
+        await backend.save_many("s", {8: b"other"}, ttl=60)
+        assert await backend.load_many("s", [8]) == {8: b"other"}
+    run(body)